@@ -1,3 +1,4 @@
+from bisect import bisect_right
 from itertools import chain
 from netaddr import iter_iprange, IPAddress, IPNetwork
 
@@ -26,29 +27,83 @@ def parse_ip_ranges(ranges, needed):
     return ip_list
 
 
+class _SubnetRange(object):
+    '''
+    Sequence of first IP addresses of subnets between two subnets of the same
+    size, computed arithmetically on access.
+    '''
+
+    def __init__(self, start, end):
+        if start.prefixlen != end.prefixlen:
+            raise ValueError('Invalid network range, start and end networks have different prefix length')
+        if start > end:
+            raise ValueError('Invalid network range, start address is higher than end address')
+        self.version = start.version
+        self.first = start.first
+        self.step = start.size
+        self.length = (end.first - start.first) // start.size + 1
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(self.length))]
+        if index < 0:
+            index += self.length
+        if not 0 <= index < self.length:
+            raise IndexError('subnet index out of range')
+        return str(IPAddress(self.first + index * self.step + 1, self.version))
+
+    def __iter__(self):
+        for index in range(self.length):
+            yield self[index]
+
+
+class _SubnetRanges(object):
+    '''
+    Concatenation of subnet ranges, indexed by bisecting range offsets.
+    '''
+
+    def __init__(self, ranges):
+        self.ranges = ranges
+        self.offsets = []
+        self.length = 0
+        for subnet_range in ranges:
+            self.offsets.append(self.length)
+            self.length += len(subnet_range)
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(self.length))]
+        if index < 0:
+            index += self.length
+        if not 0 <= index < self.length:
+            raise IndexError('subnet index out of range')
+        position = bisect_right(self.offsets, index) - 1
+        return self.ranges[position][index - self.offsets[position]]
+
+    def __iter__(self):
+        return chain(*self.ranges)
+
+
 def parse_network_ranges(ranges, iterate=False):
     '''
-    Takes comma separated list of network ranges and returns full list of first IP addresses in every given subnet.
-    Second argument is used to check if there is enough IP addresses to cover the required number of nodes.
+    Takes comma separated list of network ranges and returns sequence of first IP addresses in every given subnet.
+    Addresses are computed on access, with ``iterate`` set full list of addresses is returned.
 
-    >>> parse_network_ranges("10.10.0.1/24-10.10.10.1/24,192.168.0.1/24-192.168.10.1/24")
+    >>> list(parse_network_ranges("10.10.0.1/24-10.10.10.1/24,192.168.0.1/24-192.168.10.1/24"))
     ['10.10.0.1', '10.10.1.1', '10.10.2.1', '10.10.3.1', '10.10.4.1', '10.10.5.1', '10.10.6.1', '10.10.7.1', '10.10.8.1', '10.10.9.1', '10.10.10.1', '192.168.0.1', '192.168.1.1', '192.168.2.1', '192.168.3.1', '192.168.4.1', '192.168.5.1', '192.168.6.1', '192.168.7.1', '192.168.8.1', '192.168.9.1', '192.168.10.1']
     '''
-    def _iter_subnet_list(start, end):
-        yield str(IPAddress(start.first) + 1)
-        if start != end:
-            for ip in _iter_subnet_list(start.next(), end):
-                yield ip
-
-    generators = tuple()
+    subnet_ranges = []
 
     for _range in ranges.split(','):
         start_str, end_str = _range.split('-')
-        start, end = IPNetwork(start_str), IPNetwork(end_str)
-        if start > end:
-            raise ValueError('Invalid network range, start address is higher than end address')
-        generators += (_iter_subnet_list(start, end),)
+        subnet_ranges.append(_SubnetRange(IPNetwork(start_str), IPNetwork(end_str)))
 
     if iterate:
-        return [ip for ip in chain(*generators)]
-    return chain(*generators)
+        return [ip for subnet_range in subnet_ranges for ip in subnet_range]
+    return _SubnetRanges(subnet_ranges)
@@ -6,28 +6,52 @@ Module for handling reclass metadata models.
 
 from __future__ import absolute_import
 
+import bisect
+import collections
+import contextlib
+import fcntl
+import fnmatch
+import hashlib
 import io
 import json
 import logging
+import multiprocessing
 import os
 import socket
 import sys
+import time
 import six
 import yaml
 import re
 
 import urlparse
 
-from reclass import get_storage, output
-from reclass.adapters.salt import ext_pillar
+from six.moves import cPickle as pickle
+
+from reclass import get_storage, get_path_mangler, output
+from reclass.defaults import OPT_NODES_URI, OPT_CLASSES_URI
 from reclass.core import Core
 from reclass.config import find_and_read_configfile
 from string import Template
 from reclass.errors import ReclassException
 
+try:
+    from reclass.settings import Settings
+except ImportError:
+    # reclass < 1.5
+    Settings = None
+
+try:
+    import msgpack
+    HAS_MSGPACK = True
+except ImportError:
+    HAS_MSGPACK = False
+
 
 LOG = logging.getLogger(__name__)
 
+HAS_LIBYAML = hasattr(yaml, 'CSafeLoader') and hasattr(yaml, 'CSafeDumper')
+
 
 def __virtual__():
     '''
@@ -37,17 +61,122 @@ def __virtual__():
     return 'reclass'
 
 
-def _deps(ret_classes=True, ret_errors=False):
+def _get_option(name, default=None):
     '''
-    Returns classes if ret_classes=True, else returns soft_params if ret_classes=False
+    Returns execution module option, looked up under ``reclass:module`` key
+    in minion config, grains or pillar.
+    '''
+    return __salt__['config.get']('reclass:module:{0}'.format(name), default)
+
+
+# (Loader, Dumper) pair selected by yaml_loader option
+_YAML = None
+
+
+def _yaml_impl():
+    '''
+    Returns YAML (Loader, Dumper) pair selected by ``yaml_loader`` module
+    option. ``auto`` (default) prefers libyaml based CSafeLoader/CSafeDumper
+    when available, ``c`` requests them explicitly and ``python`` forces the
+    pure Python SafeLoader/SafeDumper.
+    '''
+    global _YAML
+
+    if _YAML is None:
+        choice = _get_option('yaml_loader', 'auto')
+        if choice not in ('auto', 'c', 'python'):
+            LOG.warning("Unknown yaml_loader %s, using auto" % choice)
+            choice = 'auto'
+        if choice == 'c' and not HAS_LIBYAML:
+            LOG.warning("libyaml is not available, using pure Python YAML loader")
+        if choice != 'python' and HAS_LIBYAML:
+            _YAML = (yaml.CSafeLoader, yaml.CSafeDumper)
+        else:
+            _YAML = (yaml.SafeLoader, yaml.SafeDumper)
+    return _YAML
+
+
+def _yaml_load(stream):
+    return yaml.load(stream, Loader=_yaml_impl()[0])
+
+
+def _yaml_dump(data):
+    return yaml.dump(data, Dumper=_yaml_impl()[1], default_flow_style=False)
+
+
+def _get_cache_dir():
+    cache_dir = _get_option('cache_dir') or os.path.join(__opts__['cachedir'], 'reclass')
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    return cache_dir
+
+
+def _cache_load(name):
+    '''
+    Returns data stored in module cache file, None if missing or unreadable.
+    '''
+    path = os.path.join(_get_cache_dir(), name)
+    if not os.path.isfile(path):
+        return None
+    try:
+        with open(path, 'rb') as file_handle:
+            return pickle.load(file_handle)
+    except Exception as e:
+        LOG.debug("Unable to load cache file %s: %s" % (path, repr(e)))
+        return None
+
+
+def _cache_dump(name, data):
+    '''
+    Atomically replaces module cache file with given data.
+    '''
+    path = os.path.join(_get_cache_dir(), name)
+    tmp_path = '{0}.{1}.tmp'.format(path, os.getpid())
+    try:
+        with open(tmp_path, 'wb') as file_handle:
+            pickle.dump(data, file_handle, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmp_path, path)
+    except (IOError, OSError) as e:
+        LOG.warning("Unable to save cache file %s: %s" % (path, repr(e)))
+
+
+@contextlib.contextmanager
+def _file_lock(path):
+    '''
+    Holds exclusive advisory lock of given lock file.
+    '''
+    with open(path, 'a') as lock_handle:
+        fcntl.flock(lock_handle.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_handle.fileno(), fcntl.LOCK_UN)
+
+
+# bump when the structure of class index entries changes
+_CLASS_INDEX_VERSION = 5
+_CLASS_INDEX_FILE = 'class_index.p'
+
+# in-memory class index and its analysis, shared for the life of the module
+_CLASS_INDEX = {}
+_CLASS_ANALYSIS = None
+
+
+def _class_name(class_file, path):
+    '''
+    Translates class file path to class name (init.yml to its directory).
+    '''
+    if class_file.endswith('/init.yml'):
+        return class_file.replace(path, '')[:-9].replace('/', '.')
+    return class_file.replace(path, '')[:-4].replace('/', '.')
+
+
+def _find_classes(path):
+    '''
+    Returns dictionary of class names and their files found in inventory.
     '''
-    defaults = _get_defaults()
-    path = defaults.get('inventory_base_uri')
     classes = {}
-    soft_params = {}
-    errors = []
 
-    # find classes
     for root, dirs, files in os.walk(path):
         # skip hidden files and folders in reclass dir
         files = [f for f in files if not f[0] == '.']
@@ -55,71 +184,475 @@ def _deps(ret_classes=True, ret_errors=False):
         # translate found init.yml to valid class name
         if 'init.yml' in files:
             class_file = root + '/' + 'init.yml'
-            class_name = class_file.replace(path, '')[:-9].replace('/', '.')
-            classes[class_name] = {'file': class_file}
+            classes[_class_name(class_file, path)] = class_file
 
         for f in files:
             if f.endswith('.yml') and f != 'init.yml':
                 class_file = root + '/' + f
-                class_name = class_file.replace(path, '')[:-4].replace('/', '.')
-                classes[class_name] = {'file': class_file}
-
-    # read classes
-    for class_name, params in classes.items():
-        LOG.debug("Processing:{}".format(params['file']))
-        with open(params['file'], 'r') as f:
-            # read raw data
-            raw = f.read()
-            pr = re.findall('\${_param:(.*?)}', raw)
-            if pr:
-                params['params_required'] = list(set(pr))
-
-            # load yaml
-            try:
-                data = yaml.load(raw)
-            except yaml.scanner.ScannerError as e:
-                errors.append(params['file'] + ' ' + str(e))
-                pass
-
-            if type(data) == dict:
-                if data.get('classes'):
-                    params['includes'] = data.get('classes', [])
-                if data.get('parameters') and data['parameters'].get('_param'):
-                    params['params_created'] = data['parameters']['_param']
-
-                if not(data.get('classes') or data.get('parameters')):
-                    errors.append(params['file'] + ' ' + 'file missing classes and parameters')
+                classes[_class_name(class_file, path)] = class_file
+
+    return classes
+
+
+def _resolve_class(include, class_name=None, class_file=None, prefix='.classes'):
+    '''
+    Returns class table name of class included by given class, None if the
+    included class name can not be resolved statically (interpolated name,
+    relative name outside of a class).
+    '''
+    if not isinstance(include, six.string_types) or '$' in include:
+        return None
+    if not include.startswith('.'):
+        return prefix + '.' + include
+    if class_name is None or not class_name.startswith(prefix + '.'):
+        return None
+    # relative class names are relative to the directory of the class file
+    base = class_name if class_file.endswith('/init.yml') else class_name.rsplit('.', 1)[0]
+    rest = include.lstrip('.')
+    for level in range(len(include) - len(rest) - 1):
+        base = base.rsplit('.', 1)[0]
+    return base + '.' + rest
+
+
+# reference without nested references
+_REFERENCE = re.compile(r'\$\{([^${}]*)\}')
+# escaped backslash followed by reference, escaped reference, reference, end
+_REFERENCE_TOKENS = re.compile(r'\\\\\$\{|\\\$\{|\$\{|\}')
+
+
+def _find_references(raw):
+    '''
+    Returns parameter references found in raw content of single class file
+    as {path: [line numbers]}. Escaped references are skipped, nested
+    references are returned both as inner reference and as outer reference
+    path containing the inner one.
+    '''
+    refs = {}
+    count = raw.count('${')
+    if not count:
+        return refs
+
+    line = 1
+    last = 0
+    # common case, all references are plain ones and found by single regex
+    if '\\${' not in raw:
+        for match in _REFERENCE.finditer(raw):
+            line += raw.count('\n', last, match.start())
+            last = match.start()
+            refs.setdefault(match.group(1), []).append(line)
+        if sum(len(lines) for lines in refs.values()) == count:
+            return refs
+        refs = {}
+        line = 1
+        last = 0
+
+    stack = []
+    for match in _REFERENCE_TOKENS.finditer(raw):
+        token = match.group()
+        if token == '}':
+            if stack:
+                start, start_line = stack.pop()
+                refs.setdefault(raw[start:match.start()], []).append(start_line)
+        elif token != '\\${':
+            line += raw.count('\n', last, match.start())
+            last = match.start()
+            stack.append((match.end(), line))
+    return refs
+
+
+def _param_keys(parameters):
+    '''
+    Returns top level parameter keys and their sub-keys, None for keys with
+    other than dictionary value.
+    '''
+    keys = {}
+    for key, value in parameters.items():
+        keys[key] = list(value) if isinstance(value, dict) else None
+    return keys
+
+
+def _parse_class(class_file, raw):
+    '''
+    Returns metadata and errors found in raw content of single class file.
+    '''
+    meta = {}
+    errors = []
+
+    refs = _find_references(raw)
+    if refs:
+        meta['references'] = refs
+        pr = [path[7:] for path in refs if path.startswith('_param:') and '${' not in path]
+        if pr:
+            meta['params_required'] = pr
+
+    # load yaml
+    try:
+        data = _yaml_load(raw)
+    except yaml.YAMLError as e:
+        errors.append(class_file + ' ' + str(e))
+        return meta, errors
+
+    if type(data) == dict:
+        if data.get('classes'):
+            meta['includes'] = data.get('classes', [])
+        if data.get('parameters') and data['parameters'].get('_param'):
+            meta['params_created'] = data['parameters']['_param']
+        if isinstance(data.get('parameters'), dict):
+            meta['param_keys'] = _param_keys(data['parameters'])
+
+        if not(data.get('classes') or data.get('parameters')):
+            errors.append(class_file + ' ' + 'file missing classes and parameters')
+    else:
+        errors.append(class_file + ' ' + 'is not valid yaml')
+
+    return meta, errors
+
+
+def _read_class(class_file):
+    LOG.debug("Processing:{}".format(class_file))
+    with open(class_file, 'r') as f:
+        return _parse_class(class_file, f.read())
+
+
+def _read_node(file_path):
+    with open(file_path, 'r') as file_handle:
+        return _yaml_load(file_handle.read())
+
+
+def _parse_task(func, path):
+    '''
+    Runs single parsing task, exceptions are returned as error messages
+    instead of being raised so one bad file does not break whole scan.
+    '''
+    try:
+        return func(path), None
+    except Exception as e:
+        return None, '{0} {1}'.format(path, e)
+
+
+def _parse_worker(conn, func, chunks):
+    for chunk in chunks:
+        conn.send([_parse_task(func, path) for path in chunk])
+    conn.close()
+
+
+# below this number of files per worker the process start-up is not worth it
+_PARSE_MIN_FILES = 64
+
+
+def _parse_files(func, paths, workers=None):
+    '''
+    Applies parsing function to given files and yields (result, error)
+    tuples in the order of given paths. Files are parsed by ``parse_workers``
+    forked processes, 0 means number of CPUs, 1 parses files serially in
+    current process. Paths are split into chunks dealt round-robin to the
+    workers, so results are merged in order as they arrive. Chunks of
+    a worker which died are parsed in current process.
+
+    :param func: parsing function taking file path
+    :param paths: list of file paths
+    :param workers: number of worker processes, overrides module option
+    '''
+    if workers is None:
+        workers = int(_get_option('parse_workers', 1))
+    if workers <= 0:
+        workers = multiprocessing.cpu_count()
+    workers = min(workers, len(paths) // _PARSE_MIN_FILES or 1)
+    # resolve YAML implementation once, forked workers inherit it
+    _yaml_impl()
+
+    # daemonic processes (e.g. some salt job processes) can not fork workers
+    if workers <= 1 or multiprocessing.current_process().daemon:
+        for path in paths:
+            yield _parse_task(func, path)
+        return
+
+    chunksize = max(1, len(paths) // (workers * 4))
+    chunks = [paths[i:i + chunksize] for i in range(0, len(paths), chunksize)]
+    procs = []
+    try:
+        for i in range(workers):
+            recv_conn, send_conn = multiprocessing.Pipe(False)
+            proc = multiprocessing.Process(target=_parse_worker,
+                                           args=(send_conn, func, chunks[i::workers]))
+            proc.daemon = True
+            proc.start()
+            send_conn.close()
+            procs.append((proc, recv_conn))
+        dead = set()
+        for i in range(len(chunks)):
+            worker = i % workers
+            results = None
+            if worker not in dead:
+                try:
+                    results = procs[worker][1].recv()
+                except (EOFError, IOError, OSError):
+                    LOG.warning("Parse worker %s died, parsing its files in current process" % worker)
+                    dead.add(worker)
+            if results is None:
+                results = [_parse_task(func, path) for path in chunks[i]]
+            for result in results:
+                yield result
+    finally:
+        for proc, conn in procs:
+            conn.close()
+            if proc.is_alive():
+                proc.terminate()
+            proc.join()
+
+
+def _class_graph(files):
+    '''
+    Returns resolved class inclusion graph of class index entries together
+    with its reverse, so both directions are answered by single lookup.
+    '''
+    includes = {}
+    dependents = {}
+    dynamic = set()
+    for class_file, entry in files.items():
+        class_name = entry['name']
+        includes[class_name] = set()
+        for include in entry['meta'].get('includes', []):
+            resolved = _resolve_class(include, class_name, class_file)
+            if resolved is None:
+                dynamic.add(class_name)
             else:
-                errors.append(params['file'] + ' ' + 'is not valid yaml')
+                includes[class_name].add(resolved)
+                dependents.setdefault(resolved, set()).add(class_name)
+    return {'includes': includes, 'dependents': dependents, 'dynamic': dynamic}
+
+
+def _param_index(params, removed, added):
+    '''
+    Returns soft parameter index updated by removed and added class index
+    entries. Only parameters of changed classes are copied, the given index
+    is left intact as it may be shared.
+    '''
+    params = dict(params)
+    touched = set()
+
+    def param(pn):
+        if pn not in touched:
+            old = params.get(pn, {'created_at': {}, 'required_at': []})
+            params[pn] = {'created_at': dict(old['created_at']), 'required_at': list(old['required_at'])}
+            touched.add(pn)
+        return params[pn]
+
+    for entry in removed:
+        for pn in entry['meta'].get('params_created', {}):
+            param(pn)['created_at'].pop(entry['name'], None)
+        for pn in entry['meta'].get('params_required', []):
+            if entry['name'] in param(pn)['required_at']:
+                param(pn)['required_at'].remove(entry['name'])
+
+    for entry in added:
+        for pn, pv in entry['meta'].get('params_created', {}).items():
+            param(pn)['created_at'].setdefault(entry['name'], pv)
+        for pn in entry['meta'].get('params_required', []):
+            param(pn)['required_at'].append(entry['name'])
+
+    for pn in touched:
+        if not (params[pn]['created_at'] or params[pn]['required_at']):
+            del params[pn]
+    return params
+
+
+def _class_index(path, refresh=False):
+    '''
+    Returns class index of given inventory. Index entries are keyed by class
+    file path and validated by file (mtime, size, inode), so only changed
+    files are read and parsed again. Index holds also resolved class
+    inclusion graph and it is persisted in minion cache dir.
+    The same index object is returned as long as no class file changed.
+
+    :param refresh: drop persisted index and parse all class files
+    '''
+    index = None
+    if not refresh:
+        index = _CLASS_INDEX.get(path) or _cache_load(_CLASS_INDEX_FILE)
+    if not index or index.get('version') != _CLASS_INDEX_VERSION or index.get('base') != path:
+        index = {'version': _CLASS_INDEX_VERSION, 'base': path, 'files': {},
+                 'graph': _class_graph({}), 'params': {}}
+
+    scan_time = time.time()
+    files = {}
+    stale = []
+
+    for class_name, class_file in _find_classes(path).items():
+        try:
+            st = os.stat(class_file)
+        except OSError:
+            continue
+        stamp = (st.st_mtime, st.st_size, st.st_ino)
+        entry = index['files'].get(class_file)
+        if entry is None or entry['stamp'] != stamp or entry['name'] != class_name:
+            # file modified within mtime granularity could change again
+            # unnoticed, such entries are parsed again on next scan
+            if scan_time - st.st_mtime < 2:
+                stamp = None
+            stale.append((class_file, class_name, stamp))
+        else:
+            files[class_file] = entry
+
+    results = _parse_files(_read_class, [class_file for class_file, _, _ in stale])
+    for (class_file, class_name, stamp), (result, error) in zip(stale, results):
+        meta, errors = result if error is None else ({}, [error])
+        files[class_file] = {'name': class_name, 'stamp': stamp, 'meta': meta, 'errors': errors}
+    changed = bool(stale)
+
+    if changed or len(files) != len(index['files']):
+        removed = [entry for class_file, entry in index['files'].items()
+                   if files.get(class_file) is not entry]
+        added = [entry for class_file, entry in files.items()
+                 if index['files'].get(class_file) is not entry]
+        index = dict(index, files=files, graph=_class_graph(files),
+                     params=_param_index(index['params'], removed, added))
+        _cache_dump(_CLASS_INDEX_FILE, index)
+    _CLASS_INDEX.clear()
+    _CLASS_INDEX[path] = index
+
+    return index
+
+
+# class metadata used by index lookups only, not part of the class table
+_INDEX_ONLY_META = ('param_keys', 'references')
 
-    if ret_classes:
-        return classes
-    elif ret_errors:
-        return errors
 
-    # find parameters and its usage
-    for class_name, params in classes.items():
-        for pn, pv in params.get('params_created', {}).items():
-            # create param if missing
-            if pn not in soft_params:
-                soft_params[pn] = {'created_at': {}, 'required_at': []}
+class _ClassAnalysis(object):
+    '''
+    Result of single inventory scan. Class table and YAML errors are
+    computed lazily from the same class index, soft parameters and class
+    inclusion graph are maintained by the index itself.
+    '''
+
+    def __init__(self, index):
+        self.index = index
+        self._entries = None
+        self._classes = None
+        self._errors = None
+        self._param_names = None
+        self._references = None
+
+    @property
+    def entries(self):
+        '''
+        Class files and complete metadata of class index by class name.
+        '''
+        if self._entries is None:
+            self._entries = dict((entry['name'], (class_file, entry['meta']))
+                                 for class_file, entry in self.index['files'].items())
+        return self._entries
+
+    @property
+    def classes(self):
+        if self._classes is None:
+            classes = {}
+            for class_name, (class_file, meta) in self.entries.items():
+                params = {'file': class_file}
+                params.update((key, value) for key, value in meta.items() if key not in _INDEX_ONLY_META)
+                classes[class_name] = params
+            self._classes = classes
+        return self._classes
+
+    @property
+    def errors(self):
+        if self._errors is None:
+            errors = []
+            for entry in self.index['files'].values():
+                errors.extend(entry['errors'])
+            self._errors = errors
+        return self._errors
+
+    @property
+    def soft_params(self):
+        return self.index['params']
+
+    @property
+    def param_names(self):
+        '''
+        Sorted soft parameter names for prefix lookups.
+        '''
+        if self._param_names is None:
+            self._param_names = sorted(self.soft_params)
+        return self._param_names
+
+    @property
+    def references(self):
+        '''
+        Parameter reference graph, referenced paths with classes and line
+        numbers referencing them.
+        '''
+        if self._references is None:
+            references = {}
+            for class_name, (class_file, meta) in self.entries.items():
+                for path, lines in meta.get('references', {}).items():
+                    references.setdefault(path, {})[class_name] = lines
+            self._references = references
+        return self._references
+
+    @property
+    def includes(self):
+        '''
+        Resolved class inclusion graph, classes including classes which
+        can not be resolved statically are listed in ``dynamic``.
+        '''
+        return self.index['graph']['includes']
+
+    @property
+    def dynamic(self):
+        return self.index['graph']['dynamic']
+
+    @property
+    def dependents(self):
+        '''
+        Reverse class inclusion graph, classes directly including each class.
+        '''
+        return self.index['graph']['dependents']
+
+    def dependents_of(self, class_names, depth=None):
+        '''
+        Returns classes including any of given classes, directly or
+        transitively, with their distance from the nearest given class.
+
+        :param depth: maximum distance, no limit if not set
+        '''
+        ret = {}
+        queue = collections.deque((class_name, 0) for class_name in class_names)
+        while queue:
+            class_name, level = queue.popleft()
+            if depth is not None and level >= depth:
+                continue
+            for dependent in self.dependents.get(class_name, ()):
+                if dependent not in ret:
+                    ret[dependent] = level + 1
+                    queue.append((dependent, level + 1))
+        return ret
 
-            # add created_at
-            if class_name not in soft_params[pn]['created_at']:
-                soft_params[pn]['created_at'][class_name] = pv
+    def affected(self, class_names):
+        '''
+        Returns given classes and all classes including any of them,
+        directly or transitively.
+        '''
+        return set(class_names).union(self.dependents_of(class_names))
 
-        for pn in params.get('params_required', []):
-            # create param if missing
-            if pn not in soft_params:
-                soft_params[pn] = {'created_at': {}, 'required_at': []}
 
-            # add created_at
-            soft_params[pn]['required_at'].append(class_name)
+def _deps(refresh=False):
+    '''
+    Returns analysis of all classes in inventory. Analysis is shared by
+    subsequent calls until some class file changes.
+
+    :param refresh: rebuild class index from scratch
+    '''
+    global _CLASS_ANALYSIS
 
-    return soft_params
+    defaults = _get_defaults(refresh)
+    index = _class_index(defaults.get('inventory_base_uri'), refresh)
+    if _CLASS_ANALYSIS is None or _CLASS_ANALYSIS.index is not index:
+        _CLASS_ANALYSIS = _ClassAnalysis(index)
+    return _CLASS_ANALYSIS
 
 
-def _get_defaults():
+def _read_defaults():
 
     # config.get works as expected since 2018.3.x, not expected to be run (salt-run) on salt master
     # config.get tries to read minion conf, if "key" is not found
@@ -142,18 +675,203 @@ def _get_defaults():
 
     return config
 
+
+# resolved reclass configuration, its expiration and paths derived from it
+_DEFAULTS = {}
+
+
+def _get_defaults(refresh=False):
+    '''
+    Returns reclass configuration. Resolved configuration is cached for
+    ``config_ttl`` seconds (60 by default, 0 disables caching), so call
+    chains do not repeat the config.get runner round-trip. Returned
+    dictionary is shared and must not be modified.
+
+    :param refresh: drop cached configuration and resolve it again
+    '''
+    if refresh or _DEFAULTS.get('expires', 0) <= time.time():
+        config = _read_defaults()
+        _DEFAULTS.clear()
+        _DEFAULTS.update({
+            'config': config,
+            'paths': {},
+            'expires': time.time() + float(_get_option('config_ttl', 60)),
+        })
+    return _DEFAULTS['config']
+
+
+def _get_path(name, derive):
+    '''
+    Returns path derived from reclass configuration, computed once for
+    each resolved configuration.
+    '''
+    config = _get_defaults()
+    paths = _DEFAULTS['paths']
+    if name not in paths:
+        paths[name] = derive(config)
+    return paths[name]
+
+
 def _get_nodes_dir():
-    defaults = _get_defaults()
-    return defaults.get('nodes_uri') or os.path.join(defaults.get('inventory_base_uri'), 'nodes')
+    return _get_path('nodes', lambda defaults: defaults.get('nodes_uri') or
+                     os.path.join(defaults.get('inventory_base_uri'), 'nodes'))
+
 
 def _get_classes_dir():
-    defaults = _get_defaults()
-    return defaults.get('classes_uri') or os.path.join(defaults.get('inventory_base_uri'), 'classes')
+    return _get_path('classes', lambda defaults: defaults.get('classes_uri') or
+                     os.path.join(defaults.get('inventory_base_uri'), 'classes'))
 
 
 def _get_cluster_dir():
-    classes_dir = _get_classes_dir()
-    return os.path.join(classes_dir, 'cluster')
+    return _get_path('cluster', lambda defaults: os.path.join(_get_classes_dir(), 'cluster'))
+
+
+_NODE_INDEX_FILE = 'node_index.p'
+
+# in-memory node name index, see _node_index()
+_NODE_INDEX = {}
+
+
+def _walk_nodes(nodes_dir):
+    '''
+    Yields (root, file name) of all node files in nodes directory.
+    '''
+    for root, sub_folders, files in os.walk(nodes_dir):
+        # skip hidden files and folders in reclass dir
+        files = [f for f in files if not f[0] == '.']
+        sub_folders[:] = [d for d in sub_folders if not d[0] == '.']
+        for fl in files:
+            yield root, fl
+
+
+def _node_entry(nodes_dir, root, fl, file_data):
+    file_data = file_data or {}
+    classes = file_data.get('classes', [])
+    parameters = file_data.get('parameters', {}).get('_param', [])
+    name = fl.replace('.yml', '')
+    host_name = name.split('.')[0]
+    domain_name = '.'.join(name.split('.')[1:])
+    path = root.replace(nodes_dir + '/', '')
+    return name, {
+        'name': host_name,
+        'domain': domain_name,
+        'cluster': 'default',
+        'environment': 'prd',
+        'path': path,
+        'classes': classes,
+        'parameters': parameters
+    }
+
+
+def _dir_mtime(dir_path):
+    mtime = os.stat(dir_path).st_mtime
+    # directory modified within mtime granularity could change again
+    # unnoticed, such directories are always considered stale
+    if time.time() - mtime < 2:
+        return None
+    return mtime
+
+
+def _node_index_stale(index, skip=()):
+    for dir_path, mtime in index['dirs'].items():
+        if dir_path in skip:
+            continue
+        try:
+            if os.stat(dir_path).st_mtime != mtime:
+                return True
+        except OSError:
+            return True
+    return False
+
+
+def _node_index_build(nodes_dir):
+    index = {'base': nodes_dir, 'dirs': {}, 'nodes': {}}
+    # single walk, skipping hidden files and folders the same as _walk_nodes
+    for root, sub_folders, files in os.walk(nodes_dir):
+        sub_folders[:] = [d for d in sub_folders if not d[0] == '.']
+        index['dirs'][root] = _dir_mtime(root)
+        for fl in files:
+            if not fl[0] == '.':
+                index['nodes'][fl.replace('.yml', '')] = os.path.join(root, fl)
+    return index
+
+
+def _node_index(nodes_dir, rebuild=False):
+    '''
+    Returns index of node names and their files in nodes directory. Index is
+    validated by mtimes of the directories only, node files are not read.
+    Index is persisted in minion cache dir.
+
+    :param rebuild: walk nodes directory even if index seems to be valid
+    '''
+    index = None
+    if not rebuild:
+        index = _NODE_INDEX.get(nodes_dir) or _cache_load(_NODE_INDEX_FILE)
+        if index and (index.get('base') != nodes_dir or _node_index_stale(index)):
+            index = None
+
+    if index is None:
+        index = _node_index_build(nodes_dir)
+        _cache_dump(_NODE_INDEX_FILE, index)
+
+    _NODE_INDEX.clear()
+    _NODE_INDEX[nodes_dir] = index
+    return index
+
+
+def _node_index_update(name, file_path=None):
+    '''
+    Records node file created (or removed if file_path is None) by this
+    module, so the index stays valid without walking nodes directory.
+    Directories changed by this module are stored with their real mtime,
+    the mtime granularity guard applies only to changes made outside it.
+    '''
+    nodes_dir = _get_nodes_dir()
+    index = _NODE_INDEX.get(nodes_dir) or _cache_load(_NODE_INDEX_FILE)
+    if index and index.get('base') != nodes_dir:
+        index = None
+    if file_path is None:
+        file_path = index and index['nodes'].get(name)
+        if file_path is None:
+            return
+
+    # directory of the file and directories created for it up to known one
+    touched = [os.path.dirname(file_path)]
+    while index and touched[-1] not in index['dirs']:
+        if touched[-1] == nodes_dir or not touched[-1].startswith(nodes_dir + '/'):
+            index = None
+            break
+        touched.append(os.path.dirname(touched[-1]))
+
+    if (index is None or _node_index_stale(index, touched) or
+            any(index['dirs'].get(dir_path, 0) is None for dir_path in touched)):
+        # index was not valid before this change
+        index = _node_index_build(nodes_dir)
+    else:
+        index = dict(index, dirs=dict(index['dirs']), nodes=dict(index['nodes']))
+        if os.path.isfile(file_path):
+            index['nodes'][name] = file_path
+        else:
+            index['nodes'].pop(name, None)
+    for dir_path in touched:
+        if os.path.isdir(dir_path):
+            index['dirs'][dir_path] = os.stat(dir_path).st_mtime
+
+    _cache_dump(_NODE_INDEX_FILE, index)
+    _NODE_INDEX.clear()
+    _NODE_INDEX[nodes_dir] = index
+
+
+def _find_node(name):
+    '''
+    Returns file path of given node or None if node does not exist.
+    '''
+    nodes_dir = _get_nodes_dir()
+    index = _node_index(nodes_dir)
+    file_path = index['nodes'].get(name)
+    if file_path is not None and not os.path.isfile(file_path):
+        file_path = _node_index(nodes_dir, rebuild=True)['nodes'].get(name)
+    return file_path
 
 
 def _get_node_meta(name, cluster="default", environment="prd", classes=None, parameters=None):
@@ -195,37 +913,61 @@ def _get_node_meta(name, cluster="default", environment="prd", classes=None, par
     return node_meta
 
 
-def soft_meta_list():
+def soft_meta_list(refresh=False, prefix=None, regex=None):
     '''
     Returns all defined soft metadata parameters.
 
+    :param refresh: rebuild class index from scratch
+    :param prefix: return only parameters with names starting with prefix
+    :param regex: return only parameters with names matching regex
+
     CLI Examples:
 
     .. code-block:: bash
 
         salt '*' reclass.soft_meta_list
+        salt '*' reclass.soft_meta_list prefix=openstack_
+        salt '*' reclass.soft_meta_list regex='.*_version$'
     '''
-    return _deps(ret_classes=False)
-
-
-def class_list():
+    analysis = _deps(refresh)
+    soft_params = analysis.soft_params
+    if prefix is None and regex is None:
+        return soft_params
+
+    names = analysis.param_names
+    if prefix is not None:
+        start = bisect.bisect_left(names, prefix)
+        end = start
+        while end < len(names) and names[end].startswith(prefix):
+            end += 1
+        names = names[start:end]
+    if regex is not None:
+        names = [pn for pn in names if re.match(regex, pn)]
+    return dict((pn, soft_params[pn]) for pn in names)
+
+
+def class_list(refresh=False):
     '''
     Returns list of all classes defined within reclass inventory.
 
+    :param refresh: rebuild class index from scratch
+
     CLI Examples:
 
     .. code-block:: bash
 
         salt '*' reclass.class_list
+        salt '*' reclass.class_list refresh=True
     '''
-    return _deps(ret_classes=True)
+    return _deps(refresh).classes
 
 
-def soft_meta_get(name):
+def soft_meta_get(name, refresh=False):
     '''
     Returns single soft metadata parameter.
 
     :param name: expects the following format: apt_mk_version
+    :param refresh: rebuild class index from scratch
 
     CLI Examples:
 
@@ -233,19 +975,47 @@ def soft_meta_get(name):
 
         salt '*' reclass.soft_meta_get openstack_version
     '''
-    soft_params = _deps(ret_classes=False)
+    param = _deps(refresh).soft_params.get(name)
 
-    if name in soft_params:
-        return {name: soft_params.get(name)}
+    if param is not None:
+        return {name: param}
     else:
         return {'Error': 'No param {0} found'.format(name)}
 
 
-def class_get(name):
+def reference_list(path=None, prefix=None, refresh=False):
+    '''
+    Returns parameter references found in classes, each referenced path
+    with classes and line numbers referencing it.
+
+    :param path: expects the following format _param:apt_mk_version
+    :param prefix: return only paths starting with prefix, e.g. _param:
+    :param refresh: rebuild class index from scratch
+
+    CLI Examples:
+
+    .. code-block:: bash
+
+        salt '*' reclass.reference_list
+        salt '*' reclass.reference_list prefix=linux:system
+        salt '*' reclass.reference_list _param:openstack_version
+    '''
+    references = _deps(refresh).references
+    if path is not None:
+        if path in references:
+            return {path: references[path]}
+        return {'Error': 'No reference {0} found'.format(path)}
+    if prefix is not None:
+        return dict((p, refs) for p, refs in references.items() if p.startswith(prefix))
+    return references
+
+
+def class_get(name, refresh=False):
     '''
     Returns detailes information about class file in reclass inventory.
 
     :param name: expects the following format classes.system.linux.repo
+    :param refresh: rebuild class index from scratch
 
     CLI Examples:
 
@@ -253,7 +1023,7 @@ def class_get(name):
 
         salt '*' reclass.class_get classes.system.linux.repo
     '''
-    classes = _deps(ret_classes=True)
+    classes = _deps(refresh).classes
     tmp_name = '.' + name
     if tmp_name in classes:
         return {name: classes.get(tmp_name)}
@@ -261,6 +1031,55 @@ def class_get(name):
         return {'Error': 'No class {0} found'.format(name)}
 
 
+def class_dependents(name, depth=None, nodes=True, refresh=False):
+    '''
+    Returns classes and nodes including given class, directly or
+    transitively, with their distance from the class. Classes including
+    interpolated class names can not be resolved and are listed separately.
+
+    :param name: expects the following format classes.system.linux.repo
+    :param depth: maximum inclusion distance, 1 returns direct dependents only
+    :param nodes: list also dependent nodes
+    :param refresh: rebuild class index from scratch
+
+    CLI Examples:
+
+    .. code-block:: bash
+
+        salt '*' reclass.class_dependents classes.system.linux.repo
+        salt '*' reclass.class_dependents classes.system.linux.repo depth=1
+    '''
+    analysis = _deps(refresh)
+    tmp_name = '.' + name
+    if tmp_name not in analysis.classes:
+        return {'Error': 'No class {0} found'.format(name)}
+    if depth is not None:
+        depth = int(depth)
+
+    dependents = analysis.dependents_of([tmp_name], depth)
+    nodes_dir = _get_nodes_dir()
+    ret = {'classes': {}, 'nodes': {}, 'dynamic': sorted(c[1:] for c in analysis.dynamic)}
+    for class_name, level in dependents.items():
+        class_file = analysis.classes[class_name]['file']
+        if class_file.startswith(nodes_dir + '/'):
+            if nodes:
+                ret['nodes'][os.path.basename(class_file)[:-4]] = level
+        else:
+            ret['classes'][class_name[1:]] = level
+
+    # nodes stored outside of inventory base are not part of class index
+    if nodes and not nodes_dir.startswith(_get_defaults()['inventory_base_uri'] + '/'):
+        classes = dict(dependents)
+        classes[tmp_name] = 0
+        for node_name, node in _iter_nodes():
+            levels = [classes[_resolve_class(klass)] for klass in node.get('classes') or []
+                      if _resolve_class(klass) in classes]
+            if levels and (depth is None or min(levels) < depth):
+                ret['nodes'][node_name] = min(levels) + 1
+
+    return {name: ret}
+
+
 def node_create(name, path=None, cluster="default", environment="prd", classes=None, parameters=None, **kwargs):
     '''
     Create a reclass node
@@ -301,7 +1120,8 @@ def node_create(name, path=None, cluster="default", environment="prd", classes=N
         file_path = os.path.join(_get_nodes_dir(), path, name + '.yml')
 
     with open(file_path, 'w') as node_file:
-        node_file.write(yaml.safe_dump(node_meta, default_flow_style=False))
+        node_file.write(_yaml_dump(node_meta))
+    _node_index_update(name, file_path)
 
     return node_get(name)
 
@@ -331,6 +1151,7 @@ def node_delete(name, **kwargs):
         file_path = os.path.join(_get_nodes_dir(), node[name]['path'], name + '.yml')
 
     os.remove(file_path)
+    _node_index_update(name)
 
     ret = 'Node {0} deleted'.format(name)
 
@@ -349,50 +1170,82 @@ def node_get(name, path=None, **kwargs):
         salt '*' reclass.node_get name=host02.domain.com
     '''
     ret = {}
-    nodes = node_list(**kwargs)
+    file_path = _find_node(name)
 
-    if not name in nodes:
+    if file_path is None:
+        return {'Error': 'Error in retrieving node'}
+    try:
+        file_data = _read_node(file_path)
+    except Exception as e:
+        LOG.error("Unable to load node YAML %s %s" % (file_path, e))
         return {'Error': 'Error in retrieving node'}
-    ret[name] = nodes[name]
+    root, fl = os.path.split(file_path)
+    ret[name] = _node_entry(_get_nodes_dir(), root, fl, file_data)[1]
     return ret
 
 
-def node_list(**connection_args):
+def _iter_nodes(path=None, name=None, classes=None):
+    '''
+    Yields (node name, node) of nodes matching given filters. Filters are
+    applied before YAML parsing, ``path`` limits the directory walk, ``name``
+    is matched against file names and files not mentioning all ``classes``
+    are not parsed at all.
+
+    :param path: subdirectory of nodes directory
+    :param name: node name glob pattern
+    :param classes: list of classes node must have
+    '''
+    nodes_dir = _get_nodes_dir()
+    if isinstance(classes, six.string_types):
+        classes = classes.split(',')
+
+    nodes = []
+    for root, fl in _walk_nodes(os.path.join(nodes_dir, path) if path else nodes_dir):
+        if name and not fnmatch.fnmatch(fl.replace('.yml', ''), name):
+            continue
+        nodes.append((root, fl))
+
+    def read_node(file_path):
+        with open(file_path, 'r') as file_handle:
+            raw = file_handle.read()
+        if classes and not all(klass in raw for klass in classes):
+            return False, None
+        return True, _yaml_load(raw)
+
+    file_paths = [os.path.join(root, fl) for root, fl in nodes]
+    for (root, fl), (result, error) in zip(nodes, _parse_files(read_node, file_paths)):
+        if error is not None:
+            LOG.error("Unable to load node YAML %s" % error)
+            continue
+        matched, file_data = result
+        if not matched:
+            continue
+        node_name, node = _node_entry(nodes_dir, root, fl, file_data)
+        if classes and not set(classes) <= set(node['classes'] or []):
+            continue
+        yield node_name, node
+
+
+def node_list(path=None, name=None, classes=None, **connection_args):
     '''
     Return a list of available nodes
 
+    :param path: list only nodes in given subdirectory of nodes directory
+    :param name: list only nodes matching given glob pattern
+    :param classes: list only nodes having all given classes
+
     CLI Example:
 
     .. code-block:: bash
 
         salt '*' reclass.node_list
+        salt '*' reclass.node_list path=_generated name='cmp*'
+        salt '*' reclass.node_list classes=cluster.lab.openstack.compute
     '''
     ret = {}
 
-    for root, sub_folders, files in os.walk(_get_nodes_dir()):
-        # skip hidden files and folders in reclass dir
-        files = [f for f in files if not f[0] == '.']
-        sub_folders[:] = [d for d in sub_folders if not d[0] == '.']
-        for fl in files:
-            file_path = os.path.join(root, fl)
-            with open(file_path, 'r') as file_handle:
-                file_read = yaml.load(file_handle.read())
-            file_data = file_read or {}
-            classes = file_data.get('classes', [])
-            parameters = file_data.get('parameters', {}).get('_param', [])
-            name = fl.replace('.yml', '')
-            host_name = name.split('.')[0]
-            domain_name = '.'.join(name.split('.')[1:])
-            path = root.replace(_get_nodes_dir()+'/', '')
-            ret[name] = {
-                'name': host_name,
-                'domain': domain_name,
-                'cluster': 'default',
-                'environment': 'prd',
-                'path': path,
-                'classes': classes,
-                'parameters': parameters
-            }
+    for name, node in _iter_nodes(path, name, classes):
+        ret[name] = node
 
     return ret
 
@@ -419,18 +1272,79 @@ def _is_valid_ipv6_address(address):
     return True
 
 
+_GRAINS_FILE = 'graph_grains.p'
+
+
 def _get_grains(*args, **kwargs):
-    res = __salt__['saltutil.cmd'](tgt='*',
-                                   fun='grains.item',
-                                   arg=args,
-                                   **{'timeout': 10})
-    return res or {}
+    '''
+    Returns given grains of minions targeted by ``graph_target`` module
+    option (default '*'), collected with ``graph_timeout`` (default 10).
+    With ``graph_batch_size`` set, targeted minions are resolved from
+    grains cache of salt master and queried in batches of that size.
+    Result is cached in minion cache dir for ``graph_grains_ttl`` seconds
+    (default 30, 0 disables caching).
+
+    :param refresh: ignore cached grains
+    '''
+    target = _get_option('graph_target', '*')
+    ttl = float(_get_option('graph_grains_ttl', 30))
+    key = (target, args)
+
+    if ttl > 0 and not kwargs.get('refresh'):
+        cached = _cache_load(_GRAINS_FILE)
+        if cached and cached['key'] == key and time.time() - cached['time'] < ttl:
+            return cached['grains']
+
+    timeout = int(_get_option('graph_timeout', 10))
+    batch_size = int(_get_option('graph_batch_size', 0))
+    if batch_size > 0:
+        minions = list(__salt__['saltutil.runner']('cache.grains', tgt=target) or {})
+        res = {}
+        for i in range(0, len(minions), batch_size):
+            res.update(__salt__['saltutil.cmd'](tgt=minions[i:i + batch_size],
+                                                fun='grains.item',
+                                                arg=args,
+                                                tgt_type='list',
+                                                **{'timeout': timeout}) or {})
+    else:
+        res = __salt__['saltutil.cmd'](tgt=target,
+                                       fun='grains.item',
+                                       arg=args,
+                                       **{'timeout': timeout})
+    res = res or {}
+
+    if ttl > 0:
+        _cache_dump(_GRAINS_FILE, {'key': key, 'time': time.time(), 'grains': res})
+    return res
 
 
-def _guess_host_from_target(network_grains, host, domain=' '):
+def _network_index(network_grains):
+    '''
+    Returns lookup tables of minion IDs by IPv4 and IPv6 addresses built from
+    network grains of minions, together with minion FQDNs in grain order and
+    table of FQDN lookups done so far. When more minions match the same
+    address the last one in order of given grains wins.
+    '''
+    index = {'ipv4': {}, 'ipv6': {}, 'fqdn': {}, 'fqdns': []}
+    if not network_grains or not isinstance(network_grains, dict):
+        return index
+    for minion, grains in network_grains.items():
+        if grains.get('retcode', 1) != 0:
+            continue
+        ret = grains.get('ret', {})
+        for key in ('ipv4', 'ipv6'):
+            for address in ret.get(key) or []:
+                index[key][address] = minion
+        index['fqdns'].append((minion, ret.get('fqdn', '')))
+    return index
+
+
+def _guess_host_from_target(network_index, host, domain=' '):
     '''
     Guess minion ID from given host and domain arguments. Host argument can contain
-    hostname, FQDN, IPv4 or IPv6 addresses.
+    hostname, FQDN, IPv4 or IPv6 addresses. Minion is looked up in tables built
+    by _network_index, FQDN is matched as substring of minion FQDNs once per
+    distinct FQDN. The last matching minion wins.
     '''
     key = None
     value = None
@@ -448,18 +1362,31 @@ def _guess_host_from_target(network_grains, host, domain=' '):
         key = 'fqdn'
         value = '%s.%s' % (host, domain)
 
-    target = None
-    if network_grains and isinstance(network_grains, dict) and key and value:
-        for minion, grains in network_grains.items():
-            if grains.get('retcode', 1) == 0 and value in grains.get('ret', {}).get(key, ''):
+    if key == 'fqdn' and value not in network_index['fqdn']:
+        target = None
+        for minion, fqdn in network_index['fqdns']:
+            if value in fqdn:
                 target = minion
+        network_index['fqdn'][value] = target
+    target = network_index[key].get(value)
 
     return target or host
 
 
-def _interpolate_graph_data(graph_data, **kwargs):
+def _interpolate_graph_data(graph_data, network_grains=None, **kwargs):
     new_nodes = []
-    network_grains = _get_grains('ipv4', 'ipv6', 'fqdn')
+    if network_grains is None:
+        network_grains = _get_grains('ipv4', 'ipv6', 'fqdn')
+    network_index = _network_index(network_grains)
+    # known hosts, (host, service) pairs and hosts of every service
+    hosts = set()
+    pairs = set()
+    service_hosts = {}
+    for node in graph_data:
+        hosts.add(node.get('host', ''))
+        pairs.add((node.get('host', ''), node.get('service', '')))
+        service_hosts.setdefault(node.get('service', ''), []).append(node.get('host', ''))
+
     for node in graph_data:
         if not node.get('relations', []):
             node['relations'] = []
@@ -467,7 +1394,7 @@ def _interpolate_graph_data(graph_data, **kwargs):
             if not relation.get('status', None):
                 relation['status'] = 'unknown'
             if relation.get('host_from_target', None):
-                host = _guess_host_from_target(network_grains, relation.pop('host_from_target'))
+                host = _guess_host_from_target(network_index, relation.pop('host_from_target'))
                 relation['host'] = host
             if relation.get('host_external', None):
                 parsed_host_external = [urlparse.urlparse(item).netloc
@@ -479,9 +1406,11 @@ def _interpolate_graph_data(graph_data, **kwargs):
                 relation['host'] = host
                 del relation['host_external']
                 relation['service'] = service
-                host_list = [n.get('host', '') for n in graph_data + new_nodes]
-                service_list = [n.get('service', '') for n in graph_data + new_nodes if host in n.get('host', '')]
-                if host not in host_list or (host in host_list and service not in service_list):
+                # service is known if some node of the service has host
+                # containing the relation host
+                known = host in hosts and ((host, service) in pairs or
+                                           any(host in h for h in service_hosts.get(service, [])))
+                if not known:
                     new_node = {
                         'host': host,
                         'service': service,
@@ -489,6 +1418,9 @@ def _interpolate_graph_data(graph_data, **kwargs):
                         'relations': []
                     }
                     new_nodes.append(new_node)
+                    hosts.add(host)
+                    pairs.add((host, service))
+                    service_hosts.setdefault(service, []).append(host)
 
     graph_data = graph_data + new_nodes
 
@@ -496,14 +1428,16 @@ def _interpolate_graph_data(graph_data, **kwargs):
 
 
 def _grain_graph_data(*args, **kwargs):
-    ret = _get_grains('salt:graph')
+    ret = kwargs.get('grains')
+    if ret is None:
+        ret = _get_grains('salt:graph')
     graph_data = []
     for minion_ret in ret.values():
         if minion_ret.get('retcode', 1) == 0:
             graph_datum = minion_ret.get('ret', {}).get('salt:graph', [])
-            graph_data = graph_data + graph_datum
+            graph_data.extend(graph_datum)
 
-    graph_nodes = _interpolate_graph_data(graph_data)
+    graph_nodes = _interpolate_graph_data(graph_data, kwargs.get('grains'))
     graph = {}
 
     for node in graph_nodes:
@@ -535,10 +1469,13 @@ def graph_data(*args, **kwargs):
     .. code-block:: bash
 
         salt-call reclass.graph_data
+        salt-call reclass.graph_data refresh=True
 
     '''
+    # graph and network grains are collected by single call
+    grains = _get_grains('salt:graph', 'ipv4', 'ipv6', 'fqdn', refresh=kwargs.get('refresh'))
     pillar_data = _pillar_graph_data().get('graph')
-    grain_data = _grain_graph_data().get('graph')
+    grain_data = _grain_graph_data(grains=grains).get('graph')
 
     for host, services in pillar_data.items():
         for service, service_data in services.items():
@@ -546,6 +1483,7 @@ def graph_data(*args, **kwargs):
             service_data.update(grain_service)
 
     graph = []
+    pairs = set()
     for host, services in pillar_data.items():
         for service, service_data in services.items():
             additional_data = {
@@ -555,6 +1493,7 @@ def graph_data(*args, **kwargs):
             }
             service_data.update(additional_data)
             graph.append(service_data)
+            pairs.add((host, service))
 
     for host, services in grain_data.items():
         for service, service_data in services.items():
@@ -564,14 +1503,89 @@ def graph_data(*args, **kwargs):
                 'status': 'success'
             }
             service_data.update(additional_data)
-            host_list = [g.get('host', '') for g in graph]
-            service_list = [g.get('service', '') for g in graph if g.get('host') == host]
-            if host not in host_list or (host in host_list and service not in service_list):
+            if (host, service) not in pairs:
                 graph.append(service_data)
+                pairs.add((host, service))
 
     return {'graph': graph}
 
 
+_TOPOLOGY_FILE = 'graph_topology.p'
+
+
+def _topology_update(graph):
+    '''
+    Updates persisted topology model by given graph and returns the model.
+    Model holds graph nodes keyed by (host, service), version increased by
+    every change of the graph and history of changes of the last
+    ``graph_history`` (default 100) versions.
+    '''
+    history_size = int(_get_option('graph_history', 100))
+    nodes = dict(((node['host'], node['service']), node) for node in graph)
+
+    with _file_lock(os.path.join(_get_cache_dir(), _TOPOLOGY_FILE + '.lock')):
+        model = _cache_load(_TOPOLOGY_FILE) or {'version': 0, 'nodes': {}, 'history': []}
+        old_nodes = model['nodes']
+        change = {
+            'added': [key for key in nodes if key not in old_nodes],
+            'removed': [key for key in old_nodes if key not in nodes],
+            'changed': [key for key in nodes if key in old_nodes and nodes[key] != old_nodes[key]],
+        }
+        if any(change.values()):
+            model['version'] += 1
+            model['nodes'] = nodes
+            model['history'].append((model['version'], change))
+            del model['history'][:-history_size]
+            _cache_dump(_TOPOLOGY_FILE, model)
+    return model
+
+
+def graph_data_delta(since=None, **kwargs):
+    '''
+    Returns changes of graph data for visualization app since given version
+    of topology model, i.e. added, changed and removed graph nodes. Whole
+    graph is returned with ``full`` set when the version is not given or it
+    is too old to be found in history of the model.
+
+    :param since: topology version returned by previous call
+
+    CLI Examples:
+
+    .. code-block:: bash
+
+        salt-call reclass.graph_data_delta
+        salt-call reclass.graph_data_delta since=42
+    '''
+    model = _topology_update(graph_data(**kwargs)['graph'])
+    version = model['version']
+    nodes = model['nodes']
+    history = model['history']
+
+    if since is not None:
+        since = int(since)
+    oldest = history[0][0] - 1 if history else version
+    if since is None or since < oldest or since > version:
+        return {'version': version, 'full': True, 'graph': list(nodes.values())}
+
+    # whether nodes touched since given version existed in that version
+    existed = {}
+    for change_version, change in history:
+        if change_version <= since:
+            continue
+        for key in change['added']:
+            existed.setdefault(key, False)
+        for key in change['removed'] + change['changed']:
+            existed.setdefault(key, True)
+
+    ret = {'version': version, 'full': False, 'added': [], 'changed': [], 'removed': []}
+    for key, before in existed.items():
+        if key in nodes:
+            ret['changed' if before else 'added'].append(nodes[key])
+        elif before:
+            ret['removed'].append({'host': key[0], 'service': key[1]})
+    return ret
+
+
 def node_update(name, classes=None, parameters=None, **connection_args):
     '''
     Update a node metadata information, classes and parameters.
@@ -610,73 +1624,123 @@ def node_update(name, classes=None, parameters=None, **connection_args):
         file_path = os.path.join(_get_nodes_dir(), path, name + '.yml')
 
     with open(file_path, 'w') as node_file:
-        node_file.write(yaml.safe_dump(node_meta, default_flow_style=False))
+        node_file.write(_yaml_dump(node_meta))
 
     return node_get(name)
 
 
-def _get_node_classes(node_data, class_mapping_fragment):
-    classes = []
-
-    for value_tmpl_string in class_mapping_fragment.get('value_template', []):
-        value_tmpl = Template(value_tmpl_string.replace('<<', '${').replace('>>', '}'))
-        rendered_value = value_tmpl.safe_substitute(node_data)
-        classes.append(rendered_value)
+def _compile_template(tmpl_string):
+    return Template(tmpl_string.replace('<<', '${').replace('>>', '}'))
 
-    for value in class_mapping_fragment.get('value', []):
-        classes.append(value)
 
-    return classes
+_CONDITIONS = {
+    'startswith': lambda val_a, val_b: val_a.startswith(val_b),
+    'equals': lambda val_a, val_b: val_a == val_b,
+}
 
 
-def _get_params(node_data, class_mapping_fragment):
-    params = {}
+def _eval_expression(expression):
+    '''
+    Returns result of rendered condition expression, None if the expression
+    does not take part in the condition.
+    '''
+    if expression and expression == 'all':
+        return True
+    elif expression:
+        val_a = expression.split('__')[0]
+        val_b = expression.split('__')[2]
+        condition = expression.split('__')[1]
+        if condition in _CONDITIONS:
+            return _CONDITIONS[condition](val_a, val_b)
+    return None
+
+
+def _compile_expression(expression_tmpl_string):
+    '''
+    Returns predicate of single condition expression. Expressions without
+    placeholders are evaluated at once, the others are split to operands and
+    operator in advance, so only operand templates are rendered per node.
+    '''
+    expression_tmpl = _compile_template(expression_tmpl_string)
+    placeholders = [match for match in expression_tmpl.pattern.finditer(expression_tmpl.template)
+                    if match.group('named') or match.group('braced')]
+    if not placeholders:
+        result = _eval_expression(expression_tmpl.safe_substitute({}))
+        return lambda node_data: result
+
+    parts = expression_tmpl.template.split('__')
+    balanced = all([part.count('${') == part.count('}') for part in parts[:3]])
+    if len(parts) >= 3 and parts[1] in _CONDITIONS and balanced:
+        tmpl_a = Template(parts[0])
+        tmpl_b = Template(parts[2])
+        condition = _CONDITIONS[parts[1]]
+
+        def predicate(node_data):
+            val_a = tmpl_a.safe_substitute(node_data)
+            val_b = tmpl_b.safe_substitute(node_data)
+            # rendered value containing separator changes the split
+            if '__' in val_a or '__' in val_b:
+                return _eval_expression(expression_tmpl.safe_substitute(node_data))
+            return condition(val_a, val_b)
+        return predicate
+
+    return lambda node_data: _eval_expression(expression_tmpl.safe_substitute(node_data))
+
+
+def _compile_params(class_mapping_fragment):
+    params = []
 
     for param_name, param in class_mapping_fragment.items():
         value = param.get('value', None)
         value_tmpl_string = param.get('value_template', None)
         if value:
-            params.update({param_name: value})
+            params.append((param_name, value, None))
         elif value_tmpl_string:
-            value_tmpl = Template(value_tmpl_string.replace('<<', '${').replace('>>', '}'))
-            rendered_value = value_tmpl.safe_substitute(node_data)
-            params.update({param_name: rendered_value})
+            params.append((param_name, None, _compile_template(value_tmpl_string)))
 
     return params
 
 
-def _validate_condition(node_data, expressions):
+def _compile_class_mapping_type(node_type):
+    expressions = node_type.get('expression', '')
     # allow string expression definition for single expression conditions
     if isinstance(expressions, six.string_types):
         expressions = [expressions]
+    node_class = node_type.get('node_class', {})
+
+    return {
+        'condition': [_compile_expression(expression) for expression in expressions],
+        'class_templates': [_compile_template(tmpl) for tmpl in node_class.get('value_template', [])],
+        'classes': list(node_class.get('value', [])),
+        'node_params': _compile_params(node_type.get('node_param', {})),
+        'cluster_params': _compile_params(node_type.get('cluster_param', {})),
+    }
 
-    result = []
-    for expression_tmpl_string in expressions:
-        expression_tmpl = Template(expression_tmpl_string.replace('<<', '${').replace('>>', '}'))
-        expression = expression_tmpl.safe_substitute(node_data)
 
-        if expression and expression == 'all':
-            result.append(True)
-        elif expression:
-            val_a = expression.split('__')[0]
-            val_b = expression.split('__')[2]
-            condition = expression.split('__')[1]
-            if condition == 'startswith':
-                result.append(val_a.startswith(val_b))
-            elif condition == 'equals':
-                result.append(val_a == val_b)
+def _compile_class_mapping(class_mapping):
+    '''
+    Returns compiled class_mapping, so classification of many nodes by the
+    same mapping only renders the templates.
+    '''
+    return [_compile_class_mapping_type(node_type) for type_name, node_type in class_mapping.items()]
 
-    return all(result)
 
+def _render_params(node_data, compiled_params):
+    params = {}
 
-def node_classify(node_name, node_data={}, class_mapping={}, **kwargs):
-    '''
-    CLassify node by given class_mapping dictionary
+    for param_name, value, value_tmpl in compiled_params:
+        if value_tmpl is None:
+            params[param_name] = value
+        else:
+            params[param_name] = value_tmpl.safe_substitute(node_data)
+
+    return params
 
-    :param node_name: node FQDN
-    :param node_data: dictionary of known informations about the node
-    :param class_mapping: dictionary of classes and parameters, with conditions
 
+def _classify(node_data, compiled_mapping):
+    '''
+    Returns classes, node parameters and cluster parameters generated for
+    given node by class_mapping compiled by _compile_class_mapping.
     '''
     # clean node_data
     node_data = {k: v for (k, v) in node_data.items() if not k.startswith('__')}
@@ -684,138 +1748,839 @@ def node_classify(node_name, node_data={}, class_mapping={}, **kwargs):
     classes = []
     node_params = {}
     cluster_params = {}
-    ret = {'node_create': '', 'cluster_param': {}}
 
-    for type_name, node_type in class_mapping.items():
-        valid = _validate_condition(node_data, node_type.get('expression', ''))
+    for node_type in compiled_mapping:
+        results = [predicate(node_data) for predicate in node_type['condition']]
+        valid = all([result for result in results if result is not None])
         if valid:
-            gen_classes = _get_node_classes(node_data, node_type.get('node_class', {}))
-            classes = classes + gen_classes
-            gen_node_params = _get_params(node_data, node_type.get('node_param', {}))
-            node_params.update(gen_node_params)
-            gen_cluster_params = _get_params(node_data, node_type.get('cluster_param', {}))
-            cluster_params.update(gen_cluster_params)
+            classes.extend([tmpl.safe_substitute(node_data) for tmpl in node_type['class_templates']])
+            classes.extend(node_type['classes'])
+            node_params.update(_render_params(node_data, node_type['node_params']))
+            cluster_params.update(_render_params(node_data, node_type['cluster_params']))
+
+    return classes, node_params, cluster_params
+
+
+def node_classify(node_name, node_data={}, class_mapping={}, **kwargs):
+    '''
+    CLassify node by given class_mapping dictionary
+
+    :param node_name: node FQDN
+    :param node_data: dictionary of known informations about the node
+    :param class_mapping: dictionary of classes and parameters, with conditions
+
+    '''
+    ret = {'node_create': '', 'cluster_param': {}}
+
+    classes, node_params, cluster_params = _classify(node_data, _compile_class_mapping(class_mapping))
 
     if classes:
         create_kwargs = {'name': node_name, 'path': '_generated', 'classes': classes, 'parameters': node_params}
         ret['node_create'] = node_create(**create_kwargs)
 
-    for name, value in cluster_params.items():
-        ret['cluster_param'][name] = cluster_meta_set(name, value)
+    if cluster_params:
+        meta_ret = cluster_meta_update(cluster_params)
+        for name in cluster_params:
+            ret['cluster_param'][name] = meta_ret.get(name, meta_ret)
+
+    return ret
+
+
+def node_classify_batch(nodes, class_mapping={}, **kwargs):
+    '''
+    Classify multiple nodes by given class_mapping dictionary. Node files are
+    written for every node, cluster parameters of all nodes are merged (in
+    order of given nodes) and written to overrides file at once.
+
+    :param nodes: dictionary of node FQDNs and their node_data, or list of
+                  (node FQDN, node_data) pairs
+    :param class_mapping: dictionary of classes and parameters, with conditions
+
+    CLI Examples:
+
+    .. code-block:: bash
+
+        salt-call reclass.node_classify_batch '{"cmp01.lab.local": {"node_os": "xenial"}}' class_mapping='{...}'
+    '''
+    if isinstance(nodes, dict):
+        nodes = nodes.items()
+
+    ret = {}
+    cluster_params = {}
+    cluster_param_nodes = {}
+    compiled_mapping = _compile_class_mapping(class_mapping)
+
+    for node_name, node_data in nodes:
+        ret[node_name] = {'node_create': '', 'cluster_param': {}}
+        classes, node_params, node_cluster_params = _classify(node_data or {}, compiled_mapping)
+
+        if classes:
+            create_kwargs = {'name': node_name, 'path': '_generated', 'classes': classes, 'parameters': node_params}
+            ret[node_name]['node_create'] = node_create(**create_kwargs)
+
+        for name, value in node_cluster_params.items():
+            cluster_params[name] = value
+            cluster_param_nodes.setdefault(name, []).append(node_name)
+
+    if cluster_params:
+        meta_ret = cluster_meta_update(cluster_params)
+        for name, node_names in cluster_param_nodes.items():
+            for node_name in node_names:
+                ret[node_name]['cluster_param'][name] = meta_ret.get(name, meta_ret)
+
+    return ret
+
+
+_NODE_EVENTS_FILE = 'node_events.p'
+
+
+def node_event_push(action, node_name, node_data=None, **kwargs):
+    '''
+    Queue node register/unregister event for batch processing by
+    node_event_drain. Returns True if the event opened a new batch, i.e.
+    the caller should start the batch orchestration.
+
+    :param action: register or unregister
+    :param node_name: node minion ID
+    :param node_data: dictionary of known informations about the node
+
+    CLI Examples:
+
+    .. code-block:: bash
+
+        salt-call reclass.node_event_push register cmp01.lab.local '{"node_os": "xenial"}'
+    '''
+    if action not in ('register', 'unregister'):
+        return {'Error': 'Unknown node event action {0}'.format(action)}
+
+    batch_timeout = float(_get_option('reactor_batch_timeout', 600))
+    now = time.time()
+    with _file_lock(os.path.join(_get_cache_dir(), _NODE_EVENTS_FILE + '.lock')):
+        spool = _cache_load(_NODE_EVENTS_FILE) or {'pending': None, 'events': []}
+        spool['events'].append({'action': action, 'node': node_name, 'data': node_data or {}, 'time': now})
+        # batch which was not drained in time is considered lost
+        new_batch = spool['pending'] is None or now - spool['pending'] > batch_timeout
+        if new_batch:
+            spool['pending'] = now
+        _cache_dump(_NODE_EVENTS_FILE, spool)
+
+    return new_batch
+
+
+def node_event_drain(window=None, max_wait=None, **kwargs):
+    '''
+    Wait until no node event was queued for ``window`` seconds (but not longer
+    than ``max_wait`` seconds) and take all queued events. Events of the same
+    node are coalesced, the last one wins. Returns dictionary with nodes to
+    register (with their node data) and list of nodes to unregister.
+
+    :param window: seconds without new events, defaults to reactor_window
+                   module option or 10
+    :param max_wait: maximum seconds to wait, defaults to reactor_max_wait
+                     module option or 60
+
+    CLI Examples:
+
+    .. code-block:: bash
+
+        salt-call reclass.node_event_drain window=5
+    '''
+    if window is None:
+        window = _get_option('reactor_window', 10)
+    if max_wait is None:
+        max_wait = _get_option('reactor_max_wait', 60)
+    window = float(window)
+    max_wait = float(max_wait)
+
+    lock_path = os.path.join(_get_cache_dir(), _NODE_EVENTS_FILE + '.lock')
+    start = time.time()
+    while True:
+        with _file_lock(lock_path):
+            spool = _cache_load(_NODE_EVENTS_FILE) or {'pending': None, 'events': []}
+        now = time.time()
+        last = max([event['time'] for event in spool['events']] or [start])
+        wait = min(window - (now - last), max_wait - (now - start))
+        if wait <= 0:
+            break
+        time.sleep(wait)
+
+    with _file_lock(lock_path):
+        spool = _cache_load(_NODE_EVENTS_FILE) or {'pending': None, 'events': []}
+        _cache_dump(_NODE_EVENTS_FILE, {'pending': None, 'events': []})
+
+    ret = {'register': {}, 'unregister': []}
+    for event in sorted(spool['events'], key=lambda event: event['time']):
+        if event['action'] == 'register':
+            ret['register'][event['node']] = event['data']
+            if event['node'] in ret['unregister']:
+                ret['unregister'].remove(event['node'])
+        else:
+            ret['register'].pop(event['node'], None)
+            if event['node'] not in ret['unregister']:
+                ret['unregister'].append(event['node'])
 
+    LOG.debug("Drained node events: %s" % ret)
     return ret
 
 
-def validate_yaml():
+def validate_yaml(refresh=False):
     '''
     Returns list of all reclass YAML files that contain syntax
     errors.
 
+    :param refresh: rebuild class index from scratch
+
     CLI Examples:
 
     .. code-block:: bash
 
         salt-call reclass.validate_yaml
     '''
-    errors = _deps(ret_classes=False, ret_errors=True)
+    errors = _deps(refresh).errors
     if errors:
         ret = {'Errors': errors}
         return ret
 
 
-def validate_pillar(node_name=None, **kwargs):
+class _CountingStorage(object):
+    '''
+    Reclass storage proxy counting class loads. Storage returned by
+    get_storage caches loaded classes, so the first load of a class is
+    a miss and every following load is served from the cache.
+    '''
+
+    def __init__(self, storage):
+        self._storage = storage
+        self._loaded = set()
+        self.hits = 0
+        self.misses = 0
+
+    def get_class(self, name, *args, **kwargs):
+        key = (name, args[0] if args else kwargs.get('environment'))
+        if key in self._loaded:
+            self.hits += 1
+        else:
+            self._loaded.add(key)
+            self.misses += 1
+        return self._storage.get_class(name, *args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self._storage, name)
+
+
+def _cache_stats(hits, misses):
+    total = hits + misses
+    return {'hits': hits, 'misses': misses, 'hit_rate': round(float(hits) / total, 4) if total else 0.0}
+
+
+def _get_core(defaults):
+    '''
+    Returns reclass Core and its counting storage. Class entities loaded by
+    the storage are shared by all nodes rendered by the Core. Core is set up
+    the same way as by reclass ext_pillar called with storage type and
+    inventory base uri only, so pillars match the ones of salt master.
+    '''
+    path_mangler = get_path_mangler(defaults['storage_type'])
+    nodes_uri, classes_uri = path_mangler(defaults['inventory_base_uri'], OPT_NODES_URI, OPT_CLASSES_URI)
+    storage = _CountingStorage(get_storage(defaults['storage_type'], nodes_uri, classes_uri))
+    if Settings is None:
+        core = Core(storage, None)
+    else:
+        core = Core(storage, None, Settings({}))
+    return core, storage
+
+
+def _core_pillar(core, node_name):
+    '''
+    Returns pillar of given node rendered by shared Core, in the same form
+    as reclass ext_pillar.
+    '''
+    data = core.nodeinfo(node_name)
+    params = data.get('parameters', {})
+    params['__reclass__'] = {}
+    params['__reclass__']['nodename'] = node_name
+    params['__reclass__']['applications'] = data['applications']
+    params['__reclass__']['classes'] = data['classes']
+    params['__reclass__']['environment'] = data['environment']
+    return params
+
+
+def _validation_error(e, node_name):
+    '''
+    Returns error message of exception raised by rendering of given node.
+    '''
+    msg = "Validation failed in %s on %s" % (repr(e), node_name)
+    LOG.error(msg)
+    s = str(type(e))
+    if 'yaml.scanner.ScannerError' in s:
+        return re.sub(r"\r?\n?$", "", repr(str(e)), 1)
+    return e.message
+
+
+def _validate_node(node_name, defaults, core=None):
+    '''
+    Returns error message of given node pillar, empty string if it is valid.
+    Pillar is rendered by given shared Core, by a new one if not given.
+    '''
+    try:
+        if core is None:
+            core, storage = _get_core(defaults)
+        _core_pillar(core, node_name)
+    except (ReclassException, Exception) as e:
+        return _validation_error(e, node_name)
+    return ''
+
+
+def _validate_worker(conn, defaults):
+    # failure of Core set up is reported as error of every requested node
+    try:
+        core, storage = _get_core(defaults)
+        core_error = None
+    except (ReclassException, Exception) as e:
+        core_error = e
+    while True:
+        node_name = conn.recv()
+        if node_name is None:
+            break
+        if core_error is not None:
+            conn.send((node_name, _validation_error(core_error, node_name), 0, 0))
+            continue
+        hits, misses = storage.hits, storage.misses
+        error = _validate_node(node_name, defaults, core)
+        conn.send((node_name, error, storage.hits - hits, storage.misses - misses))
+    conn.close()
+
+
+def _validate_worker_start(defaults):
+    parent_conn, child_conn = multiprocessing.Pipe()
+    proc = multiprocessing.Process(target=_validate_worker, args=(child_conn, defaults))
+    proc.daemon = True
+    proc.start()
+    child_conn.close()
+    return {'proc': proc, 'conn': parent_conn, 'node': None, 'start': None}
+
+
+def _validate_worker_stop(worker):
+    worker['conn'].close()
+    if worker['proc'].is_alive():
+        worker['proc'].terminate()
+    worker['proc'].join()
+
+
+def _iter_validate_parallel(node_names, defaults, workers, timeout=None, deadline=None):
+    '''
+    Validates pillars of given nodes in pool of worker processes and yields
+    (node name, error, cache hits, cache misses) as the validations complete.
+    Every worker renders its nodes by single shared Core. Worker exceeding
+    per-node timeout is killed and replaced. Nodes not validated before
+    overall deadline are reported as skipped.
+    '''
+    queue = collections.deque(node_names)
+    pool = []
+    start = time.time()
+    try:
+        pool = [_validate_worker_start(defaults) for i in range(min(workers, len(queue)))]
+        while queue or any([worker['node'] for worker in pool]):
+            now = time.time()
+            if deadline and now - start > deadline:
+                break
+            idle = True
+            for i, worker in enumerate(pool):
+                if worker['node'] is None:
+                    if not queue:
+                        continue
+                    worker['node'] = queue.popleft()
+                    worker['start'] = now
+                    try:
+                        worker['conn'].send(worker['node'])
+                    except (IOError, OSError):
+                        # dead worker is detected by the following poll
+                        pass
+                    idle = False
+                elif worker['conn'].poll():
+                    try:
+                        result = worker['conn'].recv()
+                    except (EOFError, IOError, OSError):
+                        result = (worker['node'], 'Validation worker died', 0, 0)
+                        _validate_worker_stop(worker)
+                        pool[i] = worker = _validate_worker_start(defaults)
+                    worker['node'] = None
+                    idle = False
+                    yield result
+                elif timeout and now - worker['start'] > timeout:
+                    yield worker['node'], 'Validation timed out after %s seconds' % timeout, 0, 0
+                    _validate_worker_stop(worker)
+                    pool[i] = _validate_worker_start(defaults)
+                    idle = False
+            if idle:
+                time.sleep(0.05)
+
+        for node_name in [worker['node'] for worker in pool if worker['node']] + list(queue):
+            yield node_name, 'Validation skipped, deadline of %s seconds exceeded' % deadline, 0, 0
+    finally:
+        for worker in pool:
+            _validate_worker_stop(worker)
+
+
+def _validate_nodes(node_names, defaults, workers, timeout=None, deadline=None):
+    '''
+    Validates pillars of given nodes, returns node errors and class cache
+    statistics.
+    '''
+    ret = {}
+    hits = misses = 0
+
+    if (workers <= 1 and not timeout and not deadline) or multiprocessing.current_process().daemon:
+        try:
+            core, storage = _get_core(defaults)
+        except (ReclassException, Exception) as e:
+            for node_name in node_names:
+                ret[node_name] = _validation_error(e, node_name)
+        else:
+            for node_name in node_names:
+                ret[node_name] = _validate_node(node_name, defaults, core)
+            hits, misses = storage.hits, storage.misses
+    else:
+        results = _iter_validate_parallel(sorted(node_names), defaults, workers,
+                                          float(timeout or 0), float(deadline or 0))
+        for node_name, error, node_hits, node_misses in results:
+            ret[node_name] = error
+            hits += node_hits
+            misses += node_misses
+            LOG.info("Validated pillar %s/%s: %s %s" % (len(ret), len(node_names), node_name,
+                                                         error and 'failed' or 'ok'))
+
+    stats = _cache_stats(hits, misses)
+    LOG.info("Class cache: %s hits, %s misses, hit rate %s" % (stats['hits'], stats['misses'],
+                                                              stats['hit_rate']))
+    return ret, stats
+
+
+def _changed_files(rev_range):
+    '''
+    Returns files changed in given git revision range of inventory.
+    '''
+    base = _get_defaults()['inventory_base_uri']
+    res = __salt__['cmd.run_all'](['git', 'diff', '--name-only', '--no-renames', '--relative', rev_range],
+                                  cwd=base, python_shell=False)
+    if res['retcode'] != 0:
+        raise ValueError('Unable to get files changed in {0}: {1}'.format(rev_range, res['stderr']))
+    return [os.path.join(base, line) for line in res['stdout'].splitlines() if line]
+
+
+def _affected_nodes(nodes, changed):
+    '''
+    Returns names of nodes affected by changed files. A node is affected if
+    its own file changed or it includes, directly or transitively, a changed
+    class. Changed directory (e.g. submodule) changes all classes under it,
+    any other changed path affects all nodes. Classes including
+    interpolated class names and classes added by class_mappings are
+    considered to include anything.
+    '''
+    defaults = _get_defaults()
+    base = defaults['inventory_base_uri']
+    nodes_dir = _get_nodes_dir()
+    analysis = _deps()
+
+    class_files = list(analysis.index['files'])
+    changed_classes = set()
+    changed_nodes = set()
+    for path in changed:
+        if not os.path.isabs(path):
+            path = os.path.join(base, path)
+        path = os.path.normpath(path)
+        if path.endswith('.yml') and path.startswith(base + '/'):
+            changed_files = [path]
+        else:
+            # directory or submodule, all classes and nodes under it changed
+            changed_files = [f for f in class_files if f.startswith(path + '/')]
+            if not changed_files or path == nodes_dir or nodes_dir.startswith(path + '/'):
+                # other than class change, or nodes outside of class index
+                LOG.info("Changed path %s is not a class, validating all nodes" % path)
+                return set(nodes)
+        for class_file in changed_files:
+            if class_file.startswith(nodes_dir + '/'):
+                changed_nodes.add(os.path.basename(class_file)[:-4])
+            changed_classes.add(_class_name(class_file, base))
+
+    if not changed_classes:
+        return changed_nodes & set(nodes)
+
+    affected = analysis.affected(changed_classes | analysis.dynamic)
+    mapped_classes = [mapping.split()[1:] for mapping in defaults.get('class_mappings') or []]
+    mapped_classes = set([_resolve_class(klass) for klasses in mapped_classes for klass in klasses])
+    if affected & mapped_classes or None in mapped_classes:
+        return set(nodes)
+
+    ret = set()
+    for node_name, node in nodes.items():
+        node_classes = [_resolve_class(klass) for klass in node.get('classes') or []]
+        if node_name in changed_nodes or None in node_classes or affected.intersection(node_classes):
+            ret.add(node_name)
+    return ret
+
+
+def validate_pillar(node_name=None, workers=None, timeout=None, deadline=None, cache_stats=False,
+                    changed=None, rev_range=None, **kwargs):
     '''
     Validates whether the pillar of given node is in correct state.
     If node is not specified it validates pillars of all known nodes.
     Returns error message for every node with currupted metadata.
 
+    All nodes validated by single process are rendered by one reclass Core,
+    so classes shared by the nodes are loaded and parsed only once.
+
+    With ``changed`` or ``rev_range`` only nodes affected by changed files
+    are validated, result is returned as {'nodes': ..., 'skipped': ...}.
+
     :param node_name: target minion ID
+    :param workers: number of nodes validated in parallel, 0 means number of
+                    CPUs, defaults to validate_workers module option or 1
+    :param timeout: seconds to validate single node, defaults to
+                    validate_timeout module option, no limit if not set
+    :param deadline: seconds to validate all nodes, defaults to
+                     validate_deadline module option, no limit if not set
+    :param cache_stats: return class cache statistics together with node
+                        errors as {'nodes': ..., 'cache': ...}
+    :param changed: list of changed files, absolute or relative to inventory
+    :param rev_range: git revision range of inventory repository, e.g.
+                      origin/master..HEAD
 
     CLI Examples:
 
     .. code-block:: bash
 
         salt-call reclass.validate_pillar
+        salt-call reclass.validate_pillar workers=16 timeout=120 deadline=1800
+        salt-call reclass.validate_pillar cache_stats=True
+        salt-call reclass.validate_pillar rev_range=origin/master..HEAD
+        salt-call reclass.validate_pillar changed='[classes/system/linux/init.yml]'
         salt-call reclass.validate_pillar minion-id
     '''
     if node_name is None:
-        ret={}
         nodes = node_list(**kwargs)
-        for node_name, node in nodes.items():
-                ret.update(validate_pillar(node_name))
+        defaults = _get_defaults()
+        if workers is None:
+            workers = int(_get_option('validate_workers', 1))
+        if workers <= 0:
+            workers = multiprocessing.cpu_count()
+        if timeout is None:
+            timeout = _get_option('validate_timeout')
+        if deadline is None:
+            deadline = _get_option('validate_deadline')
+
+        skipped = None
+        node_names = list(nodes)
+        if changed is not None or rev_range is not None:
+            if isinstance(changed, six.string_types):
+                changed = changed.split(',')
+            changed = list(changed or [])
+            if rev_range is not None:
+                changed.extend(_changed_files(rev_range))
+            affected = _affected_nodes(nodes, changed)
+            skipped = dict([(name, 'not affected by changed files') for name in nodes if name not in affected])
+            node_names = [name for name in nodes if name in affected]
+
+        ret, stats = _validate_nodes(node_names, defaults, workers, timeout, deadline)
+
+        if skipped is not None:
+            ret = {'nodes': ret, 'skipped': skipped}
+            if cache_stats:
+                ret['cache'] = stats
+        elif cache_stats:
+            ret = {'nodes': ret, 'cache': stats}
         return ret
     else:
         defaults = _get_defaults()
-        meta = ''
-        error = None
-        try:
-            pillar = ext_pillar(node_name, {}, defaults['storage_type'], defaults['inventory_base_uri'])
-        except (ReclassException, Exception) as e:
-            msg = "Validation failed in %s on %s" % (repr(e), node_name)
-            LOG.error(msg)
-            meta = {'Error': msg}
-            s = str(type(e))
-            if 'yaml.scanner.ScannerError' in s:
-                error = re.sub(r"\r?\n?$", "", repr(str(e)), 1)
-            else:
-                error = e.message
-        if 'Error' in meta:
-            ret = {node_name: error}
-        else:
-            ret = {node_name: ''}
-        return ret
+        return {node_name: _validate_node(node_name, defaults)}
 
 
 def node_pillar(node_name, **kwargs):
     '''
     Returns pillar metadata for given node from reclass inventory.
+    Multiple nodes are rendered by one reclass Core sharing loaded classes.
 
-    :param node_name: target minion ID
+    :param node_name: target minion ID, list or comma separated minion IDs
 
     CLI Examples:
 
     .. code-block:: bash
 
         salt-call reclass.node_pillar minion_id
+        salt-call reclass.node_pillar minion_id1,minion_id2
 
     '''
     defaults = _get_defaults()
-    pillar = ext_pillar(node_name, {}, defaults['storage_type'], defaults['inventory_base_uri'])
-    output = {node_name: pillar}
+    if isinstance(node_name, six.string_types):
+        node_name = node_name.split(',')
+    output = {}
+    core, storage = _get_core(defaults)
+    for name in node_name:
+        output[name] = _core_pillar(core, name)
+    stats = _cache_stats(storage.hits, storage.misses)
+    LOG.info("Class cache: %s hits, %s misses, hit rate %s" % (stats['hits'], stats['misses'],
+                                                              stats['hit_rate']))
 
     return output
 
 
-def inventory(**connection_args):
+_INVENTORY_VERSION = 1
+_INVENTORY_FILE = 'inventory.p'
+
+# in-memory inventory snapshot, shared for the life of the module
+_INVENTORY = {}
+
+
+def _tree_stamps(path):
+    '''
+    Returns (mtime, size, inode) of all YAML files in given tree, None for
+    files modified within mtime granularity.
+    '''
+    stamps = {}
+    scan_time = time.time()
+    for root, fl in _walk_nodes(path):
+        if not fl.endswith('.yml'):
+            continue
+        file_path = os.path.join(root, fl)
+        try:
+            st = os.stat(file_path)
+        except OSError:
+            continue
+        stamps[file_path] = (st.st_mtime, st.st_size, st.st_ino) if scan_time - st.st_mtime >= 2 else None
+    return stamps
+
+
+def _fingerprint(stamps):
+    return hashlib.sha1(repr(sorted(stamps.items())).encode('utf-8')).hexdigest()
+
+
+def _inventory_entry(parameters):
+    '''
+    Returns services and roles of node with given parameters.
+    '''
+    service_classification = []
+    role_classification = []
+    for service in parameters:
+        if service not in ['_param', 'private_keys', 'public_keys', 'known_hosts']:
+            service_classification.append(service)
+            for role in parameters[service]:
+                if role not in ['_support', '_orchestrate', 'common']:
+                    role_classification.append('%s.%s' % (service, role))
+    return {
+        'roles': role_classification,
+        'services': service_classification,
+    }
+
+
+def _inventory_snapshot(refresh=False):
+    '''
+    Returns inventory snapshot, services and roles of all nodes together
+    with fingerprint of nodes and classes trees it was built from. Snapshot
+    is rebuilt from scratch when some class changed, only changed nodes are
+    rendered again when just node files changed. The ``inventory_cache``
+    module option selects where the snapshot is kept, ``memory`` (default)
+    keeps it in memory and in minion cache dir, ``disk`` in cache dir only,
+    ``off`` disables caching.
+
+    :param refresh: drop cached snapshot and render all nodes
+    '''
+    mode = _get_option('inventory_cache', 'memory')
+    nodes_dir = _get_nodes_dir()
+    classes_dir = _get_classes_dir()
+    key = (nodes_dir, classes_dir)
+
+    snapshot = None
+    if not refresh and mode != 'off':
+        snapshot = _INVENTORY.get(key) or _cache_load(_INVENTORY_FILE)
+    if not snapshot or snapshot.get('version') != _INVENTORY_VERSION or snapshot.get('key') != key:
+        snapshot = None
+
+    node_stamps = _tree_stamps(nodes_dir)
+    class_stamps = _tree_stamps(classes_dir)
+    classes_fingerprint = _fingerprint(class_stamps)
+    fingerprint = _fingerprint(dict(node_stamps, classes=classes_fingerprint))
+    # files modified within mtime granularity could change again without
+    # changing the fingerprint, snapshot is not trusted then
+    if None in class_stamps.values():
+        classes_fingerprint = None
+    if (snapshot is not None and snapshot['fingerprint'] == fingerprint and
+            classes_fingerprint is not None and None not in node_stamps.values()):
+        return snapshot
+
+    defaults = _get_defaults()
+    storage = get_storage(defaults['storage_type'], nodes_dir, classes_dir)
+    reclass = Core(storage, None)
+    names = dict((os.path.basename(file_path)[:-4], file_path) for file_path in node_stamps)
+
+    if snapshot is not None and classes_fingerprint is not None and snapshot['classes'] == classes_fingerprint:
+        changed = [name for name, file_path in names.items()
+                   if node_stamps[file_path] is None or snapshot['stamps'].get(file_path) != node_stamps[file_path]]
+        nodes = dict((name, snapshot['nodes'][name]) for name in names if name in snapshot['nodes'])
+        for name in changed:
+            nodes[name] = _inventory_entry(reclass.nodeinfo(name)['parameters'])
+        LOG.debug("Inventory snapshot updated, %s nodes rendered again" % len(changed))
+    else:
+        inventory_nodes = reclass.inventory()["nodes"]
+        nodes = dict((node, _inventory_entry(inventory_nodes[node]['parameters'])) for node in inventory_nodes)
+
+    snapshot = {
+        'version': _INVENTORY_VERSION,
+        'key': key,
+        'fingerprint': fingerprint,
+        'classes': classes_fingerprint,
+        'stamps': node_stamps,
+        'built': time.time(),
+        'nodes': nodes,
+    }
+    if mode != 'off':
+        _cache_dump(_INVENTORY_FILE, snapshot)
+    _INVENTORY.clear()
+    if mode == 'memory':
+        _INVENTORY[key] = snapshot
+    return snapshot
+
+
+def _merge_param_keys(merged, keys):
+    '''
+    Merges parameter key tree of single class into merged key tree the same
+    way reclass merges parameters, dictionaries are merged, other values and
+    keys prefixed by ~ replace previous value.
+    '''
+    for key, sub_keys in keys.items():
+        override = key.startswith('~')
+        key = key.lstrip('~')
+        if sub_keys is None:
+            merged[key] = None
+            continue
+        sub_keys = [sub_key.lstrip('~') for sub_key in sub_keys]
+        if override or merged.get(key) is None:
+            merged[key] = []
+        merged[key].extend(sub_key for sub_key in sub_keys if sub_key not in merged[key])
+
+
+def _inventory_keys():
+    '''
+    Returns services and roles of all nodes computed from parameter key
+    trees of class index, without rendering and interpolating node pillars.
+    Nodes including classes that can not be resolved statically are
+    rendered by reclass.
+    '''
+    analysis = _deps()
+    entries = analysis.entries
+    nodes_dir = _get_nodes_dir()
+    files = analysis.index['files']
+    ret = {}
+    dynamic = []
+
+    for root, fl in _walk_nodes(nodes_dir):
+        if not fl.endswith('.yml'):
+            continue
+        node_name = fl[:-4]
+        file_path = os.path.join(root, fl)
+        meta = files[file_path]['meta'] if file_path in files else _read_class(file_path)[0]
+
+        merged = {}
+        seen = set()
+
+        def merge(class_name, class_file, includes):
+            for include in includes:
+                include = _resolve_class(include, class_name, class_file)
+                if include is None:
+                    return False
+                if include in seen:
+                    continue
+                seen.add(include)
+                if include not in entries:
+                    LOG.warning("Class %s of node %s not found" % (include[1:], node_name))
+                    continue
+                include_file, params = entries[include]
+                if not merge(include, include_file, params.get('includes', [])):
+                    return False
+                _merge_param_keys(merged, params.get('param_keys', {}))
+            return True
+
+        if not merge(None, file_path, meta.get('includes', [])):
+            dynamic.append(node_name)
+            continue
+        _merge_param_keys(merged, meta.get('param_keys', {}))
+        ret[node_name] = _inventory_entry(dict((key, sub_keys or []) for key, sub_keys in merged.items()))
+
+    if dynamic:
+        defaults = _get_defaults()
+        reclass = Core(get_storage(defaults['storage_type'], nodes_dir, _get_classes_dir()), None)
+        for node_name in dynamic:
+            ret[node_name] = _inventory_entry(reclass.nodeinfo(node_name)['parameters'])
+    return ret
+
+
+def inventory(refresh=False, mode='full', **connection_args):
     '''
     Get all nodes in inventory and their associated services/roles.
 
+    :param refresh: drop cached inventory snapshot and render all nodes
+    :param mode: full renders node pillars by reclass, keys merges parameter
+                 keys of node classes without interpolating any references
+
     CLI Examples:
 
     .. code-block:: bash
 
         salt '*' reclass.inventory
+        salt '*' reclass.inventory refresh=True
+        salt '*' reclass.inventory mode=keys
     '''
-    defaults = _get_defaults()
-    storage = get_storage(defaults['storage_type'], _get_nodes_dir(), _get_classes_dir())
-    reclass = Core(storage, None)
-    nodes = reclass.inventory()["nodes"]
-    output = {}
+    if mode == 'keys':
+        return _inventory_keys()
+    return _inventory_snapshot(refresh)['nodes']
 
-    for node in nodes:
-        service_classification = []
-        role_classification = []
-        for service in nodes[node]['parameters']:
-            if service not in ['_param', 'private_keys', 'public_keys', 'known_hosts']:
-                service_classification.append(service)
-                for role in nodes[node]['parameters'][service]:
-                    if role not in ['_support', '_orchestrate', 'common']:
-                        role_classification.append('%s.%s' % (service, role))
-        output[node] = {
-            'roles': role_classification,
-            'services': service_classification,
-        }
-    return output
+
+def inventory_check(**kwargs):
+    '''
+    Compares services and roles of nodes computed by keys mode of inventory
+    with full mode, returns nodes which differ.
+
+    CLI Examples:
+
+    .. code-block:: bash
+
+        salt '*' reclass.inventory_check
+    '''
+    full = inventory()
+    keys = inventory(mode='keys')
+    ret = {}
+    for node_name in set(full) | set(keys):
+        full_node = full.get(node_name, {})
+        keys_node = keys.get(node_name, {})
+        if any(sorted(full_node.get(k, [])) != sorted(keys_node.get(k, [])) for k in ('roles', 'services')):
+            ret[node_name] = {'full': full_node, 'keys': keys_node}
+    return ret
+
+
+def inventory_info(**kwargs):
+    '''
+    Returns build time and fingerprint of cached inventory snapshot, without
+    rebuilding it.
+
+    CLI Examples:
+
+    .. code-block:: bash
+
+        salt '*' reclass.inventory_info
+    '''
+    key = (_get_nodes_dir(), _get_classes_dir())
+    snapshot = _INVENTORY.get(key) or _cache_load(_INVENTORY_FILE)
+    if not snapshot or snapshot.get('version') != _INVENTORY_VERSION or snapshot.get('key') != key:
+        return {'Error': 'No inventory snapshot found'}
+    node_stamps = _tree_stamps(key[0])
+    class_stamps = _tree_stamps(key[1])
+    fingerprint = _fingerprint(dict(node_stamps, classes=_fingerprint(class_stamps)))
+    return {
+        'built': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(snapshot['built'])),
+        'fingerprint': snapshot['fingerprint'],
+        'nodes': len(snapshot['nodes']),
+        'current': (snapshot['fingerprint'] == fingerprint and None not in node_stamps.values() and
+                    None not in class_stamps.values()),
+    }
 
 
 def cluster_meta_list(file_name="overrides.yml", cluster="", **kwargs):
@@ -833,7 +2598,7 @@ def cluster_meta_list(file_name="overrides.yml", cluster="", **kwargs):
     path = os.path.join(_get_cluster_dir(), cluster, file_name)
     try:
         with io.open(path, 'r') as file_handle:
-            meta_yaml = yaml.safe_load(file_handle.read())
+            meta_yaml = _yaml_load(file_handle.read())
         meta = meta_yaml or {}
     except Exception as e:
         msg = "Unable to load cluster metadata YAML %s: %s" % (path, repr(e))
@@ -842,6 +2607,61 @@ def cluster_meta_list(file_name="overrides.yml", cluster="", **kwargs):
     return meta
 
 
+def _cluster_meta_write(path, operations):
+    '''
+    Applies batch of ('set', name, value) and ('delete', name) operations
+    to cluster metadata override file in single read-modify-write. The file
+    is locked for the whole operation, replaced atomically by fsync'd
+    temporary file and not written at all if no entry changed. Returns
+    result of every entry, or error of the whole operation.
+    '''
+    ret = {}
+    lock_name = 'cluster_meta_{0}.lock'.format(hashlib.sha1(path.encode('utf-8')).hexdigest())
+    with _file_lock(os.path.join(_get_cache_dir(), lock_name)):
+        meta = cluster_meta_list(path)
+        if 'Error' in meta:
+            return meta
+        if not meta:
+            meta = {'parameters': {'_param': {}}}
+        metadata = meta.get('parameters', {}).get('_param', {})
+
+        changed = False
+        for operation in operations:
+            name = operation[1]
+            if operation[0] == 'delete':
+                if name not in metadata:
+                    ret[name] = {}
+                    continue
+                del metadata[name]
+                ret[name] = 'Cluster metadata entry {0} deleted'.format(name)
+            elif name in metadata and metadata[name] == operation[2]:
+                ret[name] = {name: 'Cluster metadata entry %s already exists and is in correct state' % name}
+                continue
+            else:
+                metadata[name] = operation[2]
+                ret[name] = {name: operation[2]}
+            changed = True
+        if not changed:
+            return ret
+
+        # hidden temporary file is skipped by inventory scans
+        tmp_path = os.path.join(os.path.dirname(path), '.{0}.{1}.tmp'.format(os.path.basename(path), os.getpid()))
+        try:
+            with io.open(tmp_path, 'w') as file_handle:
+                file_handle.write(unicode(_yaml_dump(meta)))
+                file_handle.flush()
+                os.fsync(file_handle.fileno())
+            os.chmod(tmp_path, os.stat(path).st_mode & 0o7777)
+            os.rename(tmp_path, path)
+        except Exception as e:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            msg = "Unable to save cluster metadata YAML %s: %s" % (path, repr(e))
+            LOG.error(msg)
+            return {'Error': msg}
+    return ret
+
+
 def cluster_meta_delete(name, file_name="overrides.yml", cluster="", **kwargs):
     '''
     Delete cluster level soft metadata override entry.
@@ -855,23 +2675,9 @@ def cluster_meta_delete(name, file_name="overrides.yml", cluster="", **kwargs):
 
         salt-call reclass.cluster_meta_delete foo
     '''
-    ret = {}
     path = os.path.join(_get_cluster_dir(), cluster, file_name)
-    meta = __salt__['reclass.cluster_meta_list'](path, **kwargs)
-    if 'Error' not in meta:
-        metadata = meta.get('parameters', {}).get('_param', {})
-        if name not in metadata:
-            return ret
-        del metadata[name]
-        try:
-            with io.open(path, 'w') as file_handle:
-                file_handle.write(unicode(yaml.safe_dump(meta, default_flow_style=False)))
-        except Exception as e:
-            msg = "Unable to save cluster metadata YAML: %s" % repr(e)
-            LOG.error(msg)
-            return {'Error': msg}
-        ret = 'Cluster metadata entry {0} deleted'.format(name)
-    return ret
+    ret = _cluster_meta_write(path, [('delete', name)])
+    return ret.get(name, ret)
 
 
 def cluster_meta_set(name, value, file_name="overrides.yml", cluster="", **kwargs):
@@ -889,23 +2695,29 @@ def cluster_meta_set(name, value, file_name="overrides.yml", cluster="", **kwarg
         salt-call reclass.cluster_meta_set foo bar
     '''
     path = os.path.join(_get_cluster_dir(), cluster, file_name)
-    meta = __salt__['reclass.cluster_meta_list'](path, **kwargs)
-    if 'Error' not in meta:
-        if not meta:
-            meta = {'parameters': {'_param': {}}}
-        metadata = meta.get('parameters', {}).get('_param', {})
-        if name in metadata and metadata[name] == value:
-            return {name: 'Cluster metadata entry %s already exists and is in correct state' % name}
-        metadata.update({name: value})
-        try:
-            with io.open(path, 'w') as file_handle:
-                file_handle.write(unicode(yaml.safe_dump(meta, default_flow_style=False)))
-        except Exception as e:
-            msg = "Unable to save cluster metadata YAML %s: %s" % (path, repr(e))
-            LOG.error(msg)
-            return {'Error': msg}
-        return cluster_meta_get(name, path, **kwargs)
-    return meta
+    ret = _cluster_meta_write(path, [('set', name, value)])
+    return ret.get(name, ret)
+
+
+def cluster_meta_update(params=None, delete=None, file_name="overrides.yml", cluster="", **kwargs):
+    '''
+    Create, update and delete multiple cluster level metadata override
+    entries with single write of the override file.
+
+    :param params: dictionary of override entries to create or update
+    :param delete: list of override entries to delete
+    :param file_name: name of the override file, defaults to: overrides.yml
+
+    CLI Examples:
+
+    .. code-block:: bash
+
+        salt-call reclass.cluster_meta_update params='{foo: bar}' delete='[baz]'
+    '''
+    path = os.path.join(_get_cluster_dir(), cluster, file_name)
+    operations = [('set', name, value) for name, value in (params or {}).items()]
+    operations.extend(('delete', name) for name in delete or [])
+    return _cluster_meta_write(path, operations)
 
 
 def cluster_meta_get(name, file_name="overrides.yml", cluster="", **kwargs):
@@ -933,3 +2745,110 @@ def cluster_meta_get(name, file_name="overrides.yml", cluster="", **kwargs):
 
     return ret
 
+
+def _export_records(fun, name=None, classes=None, nodes_path=None):
+    '''
+    Yields records of given function one by one, nodes are read from disk
+    as they are written.
+    '''
+    if fun == 'node_list':
+        for node_name, node in _iter_nodes(nodes_path, name, classes):
+            yield {node_name: node}
+    elif fun == 'inventory':
+        for node_name, node in inventory().items():
+            yield {node_name: node}
+    else:
+        for node in graph_data()['graph']:
+            yield node
+
+
+def export(fun='node_list', path=None, format='ndjson', chunk_size=None,
+           name=None, classes=None, nodes_path=None, **kwargs):
+    '''
+    Writes result of node_list, inventory or graph_data to file record by
+    record (node or graph node) instead of returning it, and returns only
+    manifest of the written file. Records are serialized as newline
+    delimited JSON or as stream of msgpack objects and written in chunks
+    of about ``chunk_size`` bytes.
+
+    :param fun: node_list, inventory or graph_data
+    :param path: output file, defaults to <cache_dir>/export/<fun>.<format>
+    :param format: ndjson or msgpack (requires msgpack library)
+    :param chunk_size: bytes buffered before write, defaults to
+                       export_chunk_size module option or 1048576
+    :param name: node_list name glob pattern
+    :param classes: node_list classes filter
+    :param nodes_path: node_list subdirectory of nodes directory
+
+    CLI Examples:
+
+    .. code-block:: bash
+
+        salt-call reclass.export node_list
+        salt-call reclass.export graph_data path=/tmp/graph.msgpack format=msgpack
+    '''
+    if fun not in ('node_list', 'inventory', 'graph_data'):
+        return {'Error': 'Unable to export {0}, expected one of node_list, inventory, graph_data'.format(fun)}
+    if format == 'msgpack':
+        if not HAS_MSGPACK:
+            return {'Error': 'msgpack library is not installed'}
+        packer = msgpack.Packer()
+        serialize = lambda record: packer.pack(record)
+    elif format == 'ndjson':
+        serialize = lambda record: json.dumps(record, default=str).encode('utf-8') + b'\n'
+    else:
+        return {'Error': 'Unknown export format {0}, expected ndjson or msgpack'.format(format)}
+    if chunk_size is None:
+        chunk_size = _get_option('export_chunk_size', 1048576)
+    chunk_size = int(chunk_size)
+
+    if path is None:
+        export_dir = os.path.join(_get_cache_dir(), 'export')
+        if not os.path.isdir(export_dir):
+            os.makedirs(export_dir)
+        path = os.path.join(export_dir, '{0}.{1}'.format(fun, format))
+    tmp_path = '{0}.{1}.tmp'.format(path, os.getpid())
+
+    checksum = hashlib.sha256()
+    records = 0
+    chunks = 0
+    size = 0
+    try:
+        with open(tmp_path, 'wb') as file_handle:
+            chunk = []
+            chunk_len = 0
+            for record in _export_records(fun, name, classes, nodes_path):
+                data = serialize(record)
+                chunk.append(data)
+                chunk_len += len(data)
+                records += 1
+                if chunk_len >= chunk_size:
+                    data = b''.join(chunk)
+                    file_handle.write(data)
+                    checksum.update(data)
+                    size += len(data)
+                    chunks += 1
+                    chunk = []
+                    chunk_len = 0
+            if chunk:
+                data = b''.join(chunk)
+                file_handle.write(data)
+                checksum.update(data)
+                size += len(data)
+                chunks += 1
+        os.rename(tmp_path, path)
+    except Exception as e:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        msg = "Unable to export {0} to {1}: {2}".format(fun, path, repr(e))
+        LOG.error(msg)
+        return {'Error': msg}
+
+    return {
+        'path': path,
+        'format': format,
+        'records': records,
+        'chunks': chunks,
+        'bytes': size,
+        'sha256': checksum.hexdigest(),
+    }
@@ -18,6 +18,17 @@ Management of reclass metadata
           neco: value1
           neco2: value2
 
+.. code-block:: yaml
+
+    classify_nodes:
+      reclass.dynamic_nodes_present:
+      - nodes:
+          cmp001.domain.com:
+            node_hostname: cmp001
+          cmp002.domain.com:
+            node_hostname: cmp002
+      - class_mapping: {}
+
 .. code-block:: yaml
 
     node_meta_01:
@@ -109,6 +120,36 @@ def dynamic_node_present(name, node_data={}, class_mapping={}, **kwargs):
     return ret
 
 
+def dynamic_nodes_present(name, nodes, class_mapping={}, **kwargs):
+    '''
+    Classify multiple nodes at once, create cluster level overrides and
+    node metadata
+
+    :param name: state ID, not used
+    :param nodes: dictionary of node FQDNs and their node_data
+    :param class_mapping: dictionary of classes and parameters, with conditions
+
+    '''
+    ret = {'name': name,
+           'changes': {},
+           'result': True,
+           'comment': 'No nodes to classify'}
+
+    if not nodes:
+        return ret
+
+    if __opts__['test']:
+        ret['result'] = None
+        ret['comment'] = 'Classification of nodes "{0}" would be updated'.format('", "'.join(sorted(nodes)))
+        return ret
+
+    classify_ret = __salt__['reclass.node_classify_batch'](nodes, class_mapping, **kwargs)
+    ret['comment'] = 'Nodes "{0}" have been created'.format('", "'.join(sorted(classify_ret)))
+    ret['changes']['Nodes'] = classify_ret
+
+    return ret
+
+
 def node_absent(name, **kwargs):
     '''
     Delete node from reclass metadata